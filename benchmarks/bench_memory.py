@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Memory usage of the RIB of flowchain.
+
+Flows are added in steps of 10k through RoutingInformationBase.bulk(),
+with the routes written to /dev/null, and the RSS of the process is
+measured after each step.
+
+    ./benchmarks/bench_memory.py --flows 100000
+"""
+
+import os
+import gc
+import sys
+import json
+import logging
+import argparse
+import tempfile
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHDIR, os.pardir))
+import flowchain
+from bench_server import write_config, prefix_of
+
+
+STEP = 10000
+
+
+def rss() :
+    """ resident set size of this process in bytes """
+
+    with open("/proc/self/statm") as f :
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def main() :
+
+    desc = "benchmark memory usage of the RIB of flowchain"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--flows", type = int, default = 100000,
+                        help = "number of flows (default 100000)")
+    parser.add_argument("--chain", default = "fp1-fn1_fp2-fn2_fp1-fn2",
+                        help = "chain of the flows " +
+                        "(default fp1-fn1_fp2-fn2_fp1-fn2)")
+    args = parser.parse_args()
+
+    flowchain.logger.setLevel(logging.ERROR)
+    flowchain.writer.out = open(os.devnull, "w")
+
+    with tempfile.TemporaryDirectory() as tmpdir :
+        config = os.path.join(tmpdir, "config.json")
+        write_config(config)
+        fps = flowchain.FunctionPools(flowchain.load_config(config))
+
+    rib = flowchain.RoutingInformationBase(fps)
+    flowchain.rib = rib
+
+    gc.collect()
+    base = rss()
+    results = []
+
+    for start in range(0, args.flows, STEP) :
+        ops = []
+        for n in range(start, min(start + STEP, args.flows)) :
+            entry = { "prefix" : prefix_of(n), "start" : "fp1-private",
+                      "chain" : args.chain }
+            ops.append(flowchain.parse_bulk_entry(entry))
+        rib.bulk(ops)
+        del(ops)
+
+        gc.collect()
+        results.append({
+            "flows" : rib.len(),
+            "rss_mb" : round(rss() / 1048576, 1),
+            "rss_mb_per_10k_flows" :
+            round((rss() - base) / 1048576 / rib.len() * STEP, 2),
+        })
+
+    print(json.dumps({
+        "chain" : args.chain,
+        "baseline_rss_mb" : round(base / 1048576, 1),
+        "steps" : results,
+    }, indent = 4))
+
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Scaling of compiling chains on worker processes of flowchain.
+
+Synthetic flows of bench_suite are encoded, and added by
+RoutingInformationBase.bulk(), with 1 to N processes of
+FunctionPools.compile_chains (--encode-workers of flowchain.py). Routes
+written to ExaBGP are hashed to check that the output does not depend on
+the number of processes.
+
+    ./benchmarks/bench_parallel.py --flows 100000 --workers 1 2 4 8
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHDIR, os.pardir))
+import flowchain
+from bench_suite import make_config, make_flows
+
+
+class HashSink :
+    """ exabgp pipe hashing routes """
+
+    def __init__(self) :
+        self.hash = hashlib.sha256()
+        self.routes = 0
+
+    def write(self, data) :
+        self.hash.update(data.encode())
+        self.routes += data.count("\n")
+        return len(data)
+
+    def flush(self) :
+        return
+
+
+def default_workers() :
+
+    workers = [1]
+    while workers[-1] * 2 <= os.cpu_count() :
+        workers.append(workers[-1] * 2)
+    if workers[-1] != os.cpu_count() :
+        workers.append(os.cpu_count())
+    return workers
+
+
+def bench_workers(path, entries, workers) :
+
+    # encode with a cold chain cache
+    fps = flowchain.FunctionPools(flowchain.load_config(path))
+    flows = [flowchain.parse_bulk_entry(entry)[1] for entry in entries]
+    keys = [flowchain.chain_key(flow) for flow in flows]
+
+    start = time.perf_counter()
+    compiled = fps.compile_chains(keys, workers)
+    for flow in flows :
+        flow.encode(fps)
+    encode = time.perf_counter() - start
+
+    # bulk into an empty RIB with a cold chain cache
+    fps = flowchain.FunctionPools(flowchain.load_config(path))
+    rib = flowchain.RoutingInformationBase(fps)
+    rib.encode_workers = workers
+    flowchain.rib = rib
+    flowchain.writer.out = HashSink()
+    ops = [flowchain.parse_bulk_entry(entry) for entry in entries]
+
+    start = time.perf_counter()
+    results = rib.bulk(ops)
+    bulk = time.perf_counter() - start
+
+    return {
+        "workers" : workers,
+        "chains" : len(fps.chain_cache),
+        "compiled_on_workers" : compiled,
+        "encode_seconds" : round(encode, 3),
+        "bulk_seconds" : round(bulk, 3),
+        "failures" : len([r for r in results if not r[0]]),
+        "routes" : flowchain.writer.out.routes,
+        "routes_sha256" : flowchain.writer.out.hash.hexdigest(),
+    }
+
+
+def main() :
+
+    desc = "benchmark compiling chains on worker processes of flowchain"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--pools", type = int, default = 4,
+                        help = "number of function pools (default 4)")
+    parser.add_argument("--functions", type = int, default = 8,
+                        help = "number of functions per pool, the last " +
+                        "is CGN (default 8)")
+    parser.add_argument("--flows", type = int, default = 100000,
+                        help = "number of flows (default 100000)")
+    parser.add_argument("--cgn-ratio", type = float, default = 0.2,
+                        help = "ratio of flows with CGN (default 0.2)")
+    parser.add_argument("--ipv6-ratio", type = float, default = 0.2,
+                        help = "ratio of IPv6 flows (default 0.2)")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help = "seed of synthetic flows (default 0)")
+    parser.add_argument("--workers", type = int, nargs = "+",
+                        default = default_workers(),
+                        help = "numbers of processes " +
+                        "(default 1, 2, 4 ... up to the number of CPUs)")
+    args = parser.parse_args()
+
+    flowchain.logger.setLevel(logging.ERROR)
+
+    cfg = make_config(args.pools, args.functions)
+    entries = make_flows(cfg, args.flows, args.cgn_ratio, args.ipv6_ratio,
+                         seed = args.seed)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir :
+        path = os.path.join(tmpdir, "config.json")
+        with open(path, "w") as f :
+            json.dump(cfg, f)
+
+        for workers in args.workers :
+            results.append(bench_workers(path, entries, workers))
+
+    base = results[0]
+    for result in results :
+        result["encode_speedup"] = round(base["encode_seconds"] /
+                                         result["encode_seconds"], 2)
+        result["bulk_speedup"] = round(base["bulk_seconds"] /
+                                       result["bulk_seconds"], 2)
+
+    print(json.dumps({
+        "cpus" : os.cpu_count(),
+        "flows" : args.flows,
+        "deterministic" : len(set([r["routes_sha256"]
+                                   for r in results])) == 1,
+        "results" : results,
+    }, indent = 4))
+
+
+if __name__ == "__main__" :
+    main()
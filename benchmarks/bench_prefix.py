@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of prefix validation: the string and regex based
+validators that flowchain.py used before class Prefix, against
+Prefix.parse().
+
+For a flow added through the REST API, the old path validated the
+prefix and prefix_natted twice (in the REST handler and in add_flow),
+compared their IP versions with whichipversion, and parsed them again
+with ipaddress for the prefix trie. The new path parses each prefix
+once.
+
+    ./benchmarks/bench_prefix.py --number 100000
+"""
+
+import os
+import re
+import sys
+import json
+import timeit
+import argparse
+import ipaddress
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHDIR, os.pardir))
+from flowchain import Prefix
+
+
+""" validators before class Prefix, without logging """
+
+def whichipversion(addr) :
+
+    if re.match(r'^(\d{1,3}\.){3,3}\d{1,3}$', addr)  :
+        return 4
+
+    if re.match(r'((([0-9a-f]{1,4}:){7}([0-9a-f]{1,4}|:))|(([0-9a-f]{1,4}:){6}(:[0-9a-f]{1,4}|((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){5}(((:[0-9a-f]{1,4}){1,2})|:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){4}(((:[0-9a-f]{1,4}){1,3})|((:[0-9a-f]{1,4})?:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){3}(((:[0-9a-f]{1,4}){1,4})|((:[0-9a-f]{1,4}){0,2}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){2}(((:[0-9a-f]{1,4}){1,5})|((:[0-9a-f]{1,4}){0,3}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){1}(((:[0-9a-f]{1,4}){1,6})|((:[0-9a-f]{1,4}){0,4}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(:(((:[0-9a-f]{1,4}){1,7})|((:[0-9a-f]{1,4}){0,5}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:)))(%.+)?\s*$', addr) :
+        return 6
+
+    return -1
+
+
+def validate_prefix(prefix) :
+
+    p, l = prefix.split("/")
+    v = whichipversion(p)
+
+    try :
+        preflen = int(l)
+    except ValueError :
+        return False
+
+    if v == 4 :
+        if preflen < 0 or preflen > 32 :
+            return False
+    elif v == 6 :
+        if preflen < 0 or preflen > 128 :
+            return False
+    else :
+        return False
+
+    return True
+
+
+def old_flow_path(prefix, prefix_natted) :
+
+    for x in range(2) :
+        validate_prefix(prefix)
+        validate_prefix(prefix_natted)
+        whichipversion(prefix.split("/")[0])
+        whichipversion(prefix_natted.split("/")[0])
+
+    for p in (prefix, prefix_natted) :
+        n = ipaddress.ip_network(p, strict = False)
+        (n.version, int(n.network_address), n.prefixlen)
+
+
+def new_flow_path(prefix, prefix_natted) :
+
+    Prefix.parse(prefix)
+    Prefix.parse(prefix_natted)
+
+
+def usec(func, args, number) :
+    """ microseconds per call """
+    t = timeit.timeit(lambda : func(*args), number = number)
+    return round(t / number * 1000000, 3)
+
+
+def main() :
+
+    desc = "benchmark prefix validation of flowchain"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--number", type = int, default = 100000,
+                        help = "calls for each measurement (default 100000)")
+    args = parser.parse_args()
+
+    cases = {
+        "ipv4" : ("10.1.1.0/24", "192.168.255.1/32"),
+        "ipv6" : ("2001:db8:1:2::/64", "2001:db8:ffff::1/128"),
+    }
+
+    results = []
+    for name, (prefix, prefix_natted) in cases.items() :
+        results.append({
+            "case" : name,
+            "old_validate_prefix_usec" : usec(validate_prefix, (prefix,),
+                                              args.number),
+            "new_prefix_parse_usec" : usec(Prefix.parse, (prefix,),
+                                           args.number),
+            "old_flow_usec" : usec(old_flow_path,
+                                   (prefix, prefix_natted), args.number),
+            "new_flow_usec" : usec(new_flow_path,
+                                   (prefix, prefix_natted), args.number),
+        })
+
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Requests per second of the REST API for each server mode of flowchain.
+
+flowchain.py is started as a separate process with its exabgp pipe
+(stdout) connected to /dev/null, and client threads send requests to
+/show/flow/json and /add for a fixed duration.
+
+    ./benchmarks/bench_server.py --modes debug threaded --clients 8
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import http.client
+
+
+FLOWCHAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "flowchain.py")
+
+
+def write_config(path) :
+
+    cfg = {}
+    for x in (1, 2) :
+        fpname = "fp%d" % x
+        y = 3 - x
+        cfg[fpname] = {
+            "community" : "290:%d000" % x,
+            "neighbor" : "45.0.0.%d" % x,
+            "function" : [
+                {
+                    "name" : "%s-fn%d" % (fpname, n),
+                    "rd-top" : "290:%d1%02d" % (x, n),
+                    "rd-bot" : "290:%d2%02d" % (x, n),
+                    "mark-top" : n,
+                    "mark-bottom" : 30 + n,
+                    "cgn" : False,
+                } for n in (1, 2)
+            ],
+            "inter-fp-rd" : {
+                "global" : { "fp%d" % y : "290:%d002" % x },
+                "private" : { "fp%d" % y : "290:%d003" % x },
+            },
+            "user-vrf-rd" : {
+                "%s-global" % fpname : "290:%d400" % x,
+                "%s-private" % fpname : "290:%d500" % x,
+            },
+        }
+
+    with open(path, "w") as f :
+        json.dump(cfg, f)
+    return
+
+
+def wait_port(port, timeout = 10) :
+
+    end = time.time() + timeout
+    while time.time() < end :
+        try :
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return True
+        except OSError :
+            time.sleep(0.1)
+    return False
+
+
+def prefix_of(n) :
+    return "%d.%d.%d.0/24" % (20 + n // 65536, n // 256 % 256, n % 256)
+
+
+def request(conn, method, path, body = None) :
+    """ returns (new connection, status) """
+
+    for retry in range(2) :
+        try :
+            conn.request(method, path, body = body)
+            res = conn.getresponse()
+            res.read()
+            if res.will_close :
+                conn.close()
+                conn = http.client.HTTPConnection(conn.host, conn.port)
+            return conn, res.status
+        except (OSError, http.client.HTTPException) :
+            conn.close()
+            conn = http.client.HTTPConnection(conn.host, conn.port)
+    return conn, None
+
+
+def run_clients(port, clients, duration, path_of) :
+    """ returns requests per second and the number of errors """
+
+    stop = time.time() + duration
+    counts = [0] * clients
+    errors = [0] * clients
+
+    def client(x) :
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        while time.time() < stop :
+            conn, status = request(conn, "GET", path_of())
+            if status == 200 :
+                counts[x] += 1
+            else :
+                errors[x] += 1
+        conn.close()
+
+    threads = [threading.Thread(target = client, args = (x,))
+               for x in range(clients)]
+    start = time.time()
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+    elapsed = time.time() - start
+
+    return sum(counts) / elapsed, sum(errors)
+
+
+def bench_mode(mode, config, port, args) :
+
+    cmd = [sys.executable, FLOWCHAIN, "--config", config,
+           "--server", mode, "--bind", "127.0.0.1", "--port", str(port),
+           "--journal", ""]
+    proc = subprocess.Popen(cmd, stdout = subprocess.DEVNULL,
+                            stderr = subprocess.DEVNULL,
+                            start_new_session = True)
+    try :
+        if not wait_port(port) :
+            raise RuntimeError("flowchain (%s) did not start" % mode)
+
+        # preload flows for /show/flow/json
+        entries = [{ "prefix" : prefix_of(n), "start" : "fp1-private",
+                     "chain" : "fp1-fn1_fp2-fn2" }
+                   for n in range(args.flows)]
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn, status = request(conn, "POST", "/bulk", json.dumps(entries))
+        conn.close()
+
+        show_rps, show_errors = run_clients(port, args.clients,
+                                            args.duration,
+                                            lambda : "/show/flow/json")
+
+        counter = itertools.count(args.flows)
+        def add_path() :
+            prefix, preflen = prefix_of(next(counter)).split("/")
+            return ("/add/%s/%s/none/none/fp1-private/fp1-fn1_fp2-fn2" %
+                    (prefix, preflen))
+
+        add_rps, add_errors = run_clients(port, args.clients,
+                                          args.duration, add_path)
+    finally :
+        os.killpg(proc.pid, 9)
+        proc.wait()
+
+    return {
+        "mode" : mode,
+        "clients" : args.clients,
+        "flows" : args.flows,
+        "show_flow_json_rps" : round(show_rps, 1),
+        "show_flow_json_errors" : show_errors,
+        "add_rps" : round(add_rps, 1),
+        "add_errors" : add_errors,
+    }
+
+
+def main() :
+
+    desc = "benchmark REST API server modes of flowchain"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--modes", nargs = "+",
+                        default = ["debug", "threaded"],
+                        help = "server modes (default: debug threaded)")
+    parser.add_argument("--clients", type = int, default = 8,
+                        help = "number of client threads (default 8)")
+    parser.add_argument("--duration", type = float, default = 5,
+                        help = "seconds for each endpoint (default 5)")
+    parser.add_argument("--flows", type = int, default = 100,
+                        help = "flows installed before /show (default 100)")
+    parser.add_argument("--port", type = int, default = 15000,
+                        help = "port for flowchain (default 15000)")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir :
+        config = os.path.join(tmpdir, "config.json")
+        write_config(config)
+        for x, mode in enumerate(args.modes) :
+            results.append(bench_mode(mode, config, args.port + x, args))
+
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == "__main__" :
+    main()
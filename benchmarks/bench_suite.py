@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite of flowchain at production scale.
+
+A synthetic config.json of --pools function pools with --functions
+functions each is generated, and synthetic flow sets of --flows flows,
+mixing IPv4/IPv6 and flows with/without CGN (NAT), are timed through
+load_config, generate_tos_flows, Flow.validate/encode,
+RoutingInformationBase.add_flow/find_flow_by_prefix/delete_flow and the
+REST API via the Flask test client. Routes to ExaBGP are written to a
+null sink. Results are printed as JSON to track regressions.
+
+    ./benchmarks/bench_suite.py --pools 4 --functions 8 \\
+        --flows 1000 10000 100000 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHDIR, os.pardir))
+import flowchain
+
+
+class NullSink :
+    """ exabgp pipe discarding routes """
+
+    def write(self, data) :
+        return len(data)
+
+    def flush(self) :
+        return
+
+
+def make_config(pools, functions) :
+    """ config of function pools fp1..fpN, each having functions
+    fpX-fn1..fpX-fnM. the last function of each pool is CGN, and every
+    pair of pools has inter-fp-rd.
+    """
+
+    cfg = {}
+    for x in range(1, pools + 1) :
+        fpname = "fp%d" % x
+        cfg[fpname] = {
+            "community" : "290:%d" % (x * 1000),
+            "neighbor" : "45.0.%d.%d" % (x // 256, x % 256),
+            "function" : [
+                {
+                    "name" : "%s-fn%d" % (fpname, n),
+                    "rd-top" : "290:%d" % (100000 + x * 1000 + n),
+                    "rd-bot" : "290:%d" % (200000 + x * 1000 + n),
+                    "mark-top" : n,
+                    "mark-bottom" : 100 + n,
+                    "cgn" : n == functions,
+                } for n in range(1, functions + 1)
+            ],
+            "inter-fp-rd" : {
+                "global" : dict([("fp%d" % y, "290:%d" %
+                                  (300000 + x * 1000 + y))
+                                 for y in range(1, pools + 1) if y != x]),
+                "private" : dict([("fp%d" % y, "290:%d" %
+                                   (400000 + x * 1000 + y))
+                                  for y in range(1, pools + 1) if y != x]),
+            },
+            "user-vrf-rd" : {
+                "%s-global" % fpname : "290:%d" % (500000 + x),
+                "%s-private" % fpname : "290:%d" % (600000 + x),
+            },
+        }
+
+    return cfg
+
+
+def prefix_of(n, ipv6) :
+
+    if ipv6 :
+        return "2001:db8:%x:%x::/64" % (n // 65536, n % 65536)
+    return "%d.%d.%d.0/24" % (10 + n // 65536, n // 256 % 256, n % 256)
+
+
+def natted_of(n, ipv6) :
+
+    if ipv6 :
+        return "2001:db9:%x:%x::1/128" % (n // 65536, n % 65536)
+    return "%d.%d.%d.1/32" % (100 + n // 65536, n // 256 % 256, n % 256)
+
+
+def make_flows(cfg, count, cgn_ratio, ipv6_ratio, seed = 0) :
+    """ bulk entries of synthetic flows. chains go through 1 to 3
+    non-CGN functions of random pools, and flows with CGN end with the
+    CGN function of a pool and have prefix_natted.
+    """
+
+    rand = random.Random(seed)
+    fpnames = sorted(cfg)
+    functions = dict([(fpname, [f["name"] for f in cfg[fpname]["function"]
+                                if not f["cgn"]])
+                      for fpname in fpnames])
+    cgns = dict([(fpname, [f["name"] for f in cfg[fpname]["function"]
+                           if f["cgn"]])
+                 for fpname in fpnames])
+
+    entries = []
+    for n in range(count) :
+        ipv6 = rand.random() < ipv6_ratio
+        cgn = rand.random() < cgn_ratio
+        fpname = rand.choice(fpnames)
+
+        chain = []
+        for x in range(rand.randint(1, 3)) :
+            fn = rand.choice(functions[rand.choice(fpnames)])
+            if not fn in chain :
+                chain.append(fn)
+        if cgn and cgns[fpname] :
+            chain.append(cgns[fpname][0])
+
+        entries.append({
+            "prefix" : prefix_of(n, ipv6),
+            "prefix_natted" : natted_of(n, ipv6) if cgn else None,
+            "start" : "%s-%s" % (fpname, rand.choice(["global", "private"])),
+            "chain" : chain,
+        })
+
+    return entries
+
+
+def timed(results, name, ops, func) :
+    """ run func and record the seconds for ops operations """
+
+    start = time.perf_counter()
+    ret = func()
+    elapsed = time.perf_counter() - start
+
+    results[name] = {
+        "ops" : ops,
+        "seconds" : round(elapsed, 6),
+        "usec_per_op" : round(elapsed / ops * 1000000, 3) if ops else None,
+    }
+    return ret
+
+
+def bench_config(path, repeat) :
+
+    results = {}
+
+    timed(results, "load_config", repeat,
+          lambda : [flowchain.FunctionPools(flowchain.load_config(path))
+                    for x in range(repeat)])
+
+    fps = flowchain.FunctionPools(flowchain.load_config(path))
+    timed(results, "generate_tos_flows", 1, fps.generate_tos_flows)
+    results["generate_tos_flows"]["routes"] = sum(
+        [len(e) + len(i) for e, i in fps.tos_announced.values()])
+
+    return results
+
+
+def bench_flows(path, entries, api_requests) :
+
+    results = {}
+    fps = flowchain.FunctionPools(flowchain.load_config(path))
+    n = len(entries)
+
+    flows = [flowchain.parse_bulk_entry(entry)[1] for entry in entries]
+
+    valid = timed(results, "flow_validate", n,
+                  lambda : [flow.validate(fps) for flow in flows])
+    results["flow_validate"]["failures"] = valid.count(False)
+
+    encoded = timed(results, "flow_encode", n,
+                    lambda : [flow.encode(fps) for flow in flows])
+    results["flow_encode"]["failures"] = encoded.count(False)
+
+    # RIB operations with new flows, as add_flow encodes them
+    flows = [flowchain.parse_bulk_entry(entry)[1] for entry in entries]
+    rib = flowchain.RoutingInformationBase(fps)
+    flowchain.rib = rib
+
+    added = timed(results, "rib_add_flow", n,
+                  lambda : [rib.add_flow(flow) for flow in flows])
+    results["rib_add_flow"]["failures"] = added.count(False)
+
+    prefixes = [flow.prefix for flow in flows]
+    found = timed(results, "rib_find_flow_by_prefix", n,
+                  lambda : [rib.find_flow_by_prefix(prefix)
+                            for prefix in prefixes])
+    results["rib_find_flow_by_prefix"]["misses"] = len(
+        [flow for flow in found if flow is None])
+
+    client = flowchain.app.test_client()
+
+    def get(path) :
+        res = client.get(path)
+        res.get_data()
+        return res.status_code
+
+    timed(results, "api_show_flow_json", 1,
+          lambda : get("/show/flow/json"))
+    timed(results, "api_show_flow_json_page", api_requests,
+          lambda : [get("/show/flow/json?limit=100&cursor=%d" % (x * 100))
+                    for x in range(api_requests)])
+    timed(results, "api_show_flow_json_query", api_requests,
+          lambda : [get("/show/flow/json?limit=100&fp=fp1&cgn=true")
+                    for x in range(api_requests)])
+
+    timed(results, "rib_delete_flow", n,
+          lambda : [rib.delete_flow(flow) for flow in flows])
+    results["rib_delete_flow"]["remaining"] = rib.len()
+
+    # REST API for a part of the flows
+    urls = [flow.url() for flow in flows[:api_requests]]
+    statuses = timed(results, "api_add", len(urls),
+                     lambda : [get(url) for url in urls])
+    results["api_add"]["failures"] = len(urls) - statuses.count(200)
+
+    statuses = timed(results, "api_delete", len(urls),
+                     lambda : [get("/delete/%s" % flow.prefix)
+                               for flow in flows[:api_requests]])
+    results["api_delete"]["failures"] = len(urls) - statuses.count(200)
+
+    body = json.dumps(entries)
+    status = timed(results, "api_bulk", n,
+                   lambda : client.post("/bulk", data = body).status_code)
+    results["api_bulk"]["status"] = status
+
+    return results
+
+
+def main() :
+
+    desc = "benchmark suite of flowchain with synthetic topologies"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--pools", type = int, default = 4,
+                        help = "number of function pools (default 4)")
+    parser.add_argument("--functions", type = int, default = 8,
+                        help = "number of functions per pool, the last " +
+                        "is CGN (default 8)")
+    parser.add_argument("--flows", type = int, nargs = "+",
+                        default = [1000, 10000, 100000],
+                        help = "sizes of flow sets " +
+                        "(default 1000 10000 100000)")
+    parser.add_argument("--cgn-ratio", type = float, default = 0.2,
+                        help = "ratio of flows with CGN (default 0.2)")
+    parser.add_argument("--ipv6-ratio", type = float, default = 0.2,
+                        help = "ratio of IPv6 flows (default 0.2)")
+    parser.add_argument("--api-requests", type = int, default = 1000,
+                        help = "max requests for each REST API " +
+                        "benchmark (default 1000)")
+    parser.add_argument("--repeat", type = int, default = 10,
+                        help = "repeat of load_config (default 10)")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help = "seed of synthetic flows (default 0)")
+    parser.add_argument("--output", default = None,
+                        help = "file to write results (default stdout)")
+    args = parser.parse_args()
+
+    flowchain.logger.setLevel(logging.ERROR)
+    flowchain.writer.out = NullSink()
+
+    cfg = make_config(args.pools, args.functions)
+    results = {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "topology" : {
+            "pools" : args.pools,
+            "functions" : args.functions,
+            "cgn_ratio" : args.cgn_ratio,
+            "ipv6_ratio" : args.ipv6_ratio,
+        },
+        "flow_sets" : [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir :
+        path = os.path.join(tmpdir, "config.json")
+        with open(path, "w") as f :
+            json.dump(cfg, f)
+
+        results["config"] = bench_config(path, args.repeat)
+
+        for count in args.flows :
+            entries = make_flows(cfg, count, args.cgn_ratio,
+                                 args.ipv6_ratio, seed = args.seed)
+            requests = min(count, args.api_requests)
+            result = bench_flows(path, entries, requests)
+            results["flow_sets"].append({ "flows" : count,
+                                          "benchmarks" : result })
+
+    out = json.dumps(results, indent = 4)
+    if args.output :
+        with open(args.output, "w") as f :
+            f.write(out + "\n")
+    else :
+        print(out)
+
+
+if __name__ == "__main__" :
+    main()
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 
 
-import re
 import os
 import sys
 import json
 import time
-
-from logging import getLogger, DEBUG, StreamHandler, Formatter
+import bisect
+import gc
+import atexit
+import socket
+import signal
+import asyncio
+import argparse
+import threading
+import contextlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+from logging import getLogger, DEBUG, CRITICAL, StreamHandler, Formatter
 from logging.handlers import SysLogHandler
 logger = getLogger(__name__)
 logger.setLevel(DEBUG)
@@ -19,33 +30,1055 @@ logger.addHandler(syslog)
 logger.propagate = False
 
 
-from flask import Flask, make_response, jsonify
+from flask import Flask, Response, make_response, jsonify, request, g
+from werkzeug.serving import make_server, WSGIRequestHandler
 app = Flask(__name__)
 
 rib = None # Routing Information Base for flow routes
 
 
 class logger_wrapper :
+    """ logger keeping the last error message for each thread, which is
+    returned as the response of the REST API request on the thread.
+    """
+
     def __init__(self) :
-        errmsg = None
+        self.local = threading.local()
         return
 
+    @property
+    def errmsg(self) :
+        return getattr(self.local, "errmsg", None)
+
+    @errmsg.setter
+    def errmsg(self, msg) :
+        self.local.errmsg = msg
+
     def info(self, msg) :
         logger.info("INFO: %s" % msg)
 
+    def warn(self, msg) :
+        logger.warning("WARNING: %s" % msg)
+
     def error(self, msg) :
         self.errmsg = msg
         logger.error("ERROR: %s" % msg)
 
-# XXX: should handle with individual logger_wrapper instances for each request
 log = logger_wrapper()
 
 
+class RWLock :
+    """ readers-writer lock. readers share the lock, and a writer holds
+    it exclusively. waiting writers block new readers, so that readers
+    polling continuously do not starve writers. not reentrant.
+    """
+
+    def __init__(self) :
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        return
+
+    @contextlib.contextmanager
+    def read(self) :
+
+        with self.cond :
+            while self.writer or self.writers_waiting :
+                self.cond.wait()
+            self.readers += 1
+        try :
+            yield
+        finally :
+            with self.cond :
+                self.readers -= 1
+                if not self.readers :
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self) :
+
+        with self.cond :
+            self.writers_waiting += 1
+            while self.writer or self.readers :
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try :
+            yield
+        finally :
+            with self.cond :
+                self.writer = False
+                self.cond.notify_all()
+
+
+class Histogram :
+    """ histogram of observed values with buckets of Prometheus """
+
+    # seconds, from 10 usec to 10 sec
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+               0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets = BUCKETS) :
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        return
+
+    def observe(self, value) :
+
+        x = bisect.bisect_left(self.buckets, value)
+        with self.lock :
+            self.counts[x] += 1
+            self.sum += value
+        return
+
+    def samples(self) :
+        """ (suffix, le, value) of the buckets, sum and count """
+
+        with self.lock :
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for le, count in zip(self.buckets + ("+Inf",), counts) :
+            cumulative += count
+            samples.append(("_bucket", str(le), cumulative))
+        samples.append(("_sum", None, total))
+        samples.append(("_count", None, cumulative))
+        return samples
+
+
+class Metrics :
+    """ counters and histograms exposed at /metrics in the text format
+    of Prometheus. labels are tuples of (name, value).
+    """
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.counters = {} # key: (name, labels), value: number
+        self.histograms = {} # key: (name, labels), value: Histogram
+        self.helps = {} # key: name, value: (type, help)
+        return
+
+    def describe(self, name, mtype, help) :
+        self.helps[name] = (mtype, help)
+        return
+
+    def inc(self, name, labels = (), value = 1) :
+
+        key = (name, labels)
+        with self.lock :
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+    def observe(self, name, value, labels = ()) :
+
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None :
+            with self.lock :
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+        return
+
+    def timed(self, name, help) :
+        """ decorator observing seconds of calls of a function into the
+        histogram name. falsy returns are counted in name_failures_total.
+        """
+
+        self.describe(name, "histogram", help)
+        failures = name.replace("_seconds", "") + "_failures_total"
+        self.describe(failures, "counter",
+                      help.replace("seconds of", "failures of"))
+        self.inc(failures, value = 0)
+
+        histogram = self.histograms.setdefault((name, ()), Histogram())
+        clock = time.perf_counter
+
+        def decorator(func) :
+            def wrapper(*args, **kwargs) :
+                start = clock()
+                ret = func(*args, **kwargs)
+                histogram.observe(clock() - start)
+                if not ret :
+                    self.inc(failures)
+                return ret
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            wrapper.__wrapped__ = func
+            return wrapper
+
+        return decorator
+
+    def format_labels(self, labels) :
+
+        if not labels :
+            return ""
+        return "{%s}" % ",".join(['%s="%s"' % (k, str(v)
+                                               .replace("\\", "\\\\")
+                                               .replace("\n", "\\n")
+                                               .replace('"', '\\"'))
+                                  for k, v in labels])
+
+    def render(self, families = []) :
+        """ metrics in the text format. @families: list of (name, type,
+        help, list of (labels, value)) collected at the time, such as
+        gauges.
+        """
+
+        samples = {} # key: name, value: list of lines
+
+        with self.lock :
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+
+        for (name, labels), value in counters :
+            samples.setdefault(name, []).append(
+                "%s%s %s" % (name, self.format_labels(labels), value))
+
+        for (name, labels), histogram in histograms :
+            for suffix, le, value in histogram.samples() :
+                l = labels + (("le", le),) if le else labels
+                samples.setdefault(name, []).append(
+                    "%s%s%s %s" % (name, suffix, self.format_labels(l),
+                                   value))
+
+        helps = dict(self.helps)
+        for name, mtype, help, values in families :
+            helps[name] = (mtype, help)
+            samples[name] = ["%s%s %s" % (name, self.format_labels(labels),
+                                          value)
+                             for labels, value in values]
+
+        lines = []
+        for name in sorted(helps) :
+            mtype, help = helps[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, mtype))
+            lines.extend(samples.get(name, []))
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+
+class TokenBucket :
+    """ limit of routes per second. rate 0 means no limit. """
+
+    def __init__(self, rate = 0) :
+        self.rate = rate
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.wait = 0 # seconds to wait for tokens
+        return
+
+    def allow(self, n, now) :
+        """ number of routes, up to n, allowed to be written now. if 0,
+        self.wait is the seconds to wait for tokens.
+        """
+
+        if not self.rate :
+            return n
+
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        # write at most 10 times per second under the rate limit
+        chunk = min(n, max(1, self.rate // 10))
+        if self.tokens < chunk :
+            self.wait = (chunk - self.tokens) / self.rate
+            return 0
+        return min(n, int(self.tokens))
+
+    def consume(self, n) :
+        if self.rate :
+            self.tokens -= n
+        return
+
+
+class NeighborQueue :
+    """ queue of exabgp commands to a neighbor """
+
+    def __init__(self, address, routes_per_second = 0) :
+
+        self.address = address
+        self.queue = collections.deque()
+        self.bucket = TokenBucket(routes_per_second)
+        self.paused = False
+
+        # numbers of commands queued or waiting for acknowledgements,
+        # only if ExaBGPWriter.track_acks is True.
+        self.outstanding = collections.deque()
+
+        # statistics
+        self.queue_peak = 0
+        self.routes_written = 0
+        self.drained = 0
+        # key: NLRI of an announce drained, value: number of the command.
+        # the routes are lost until the neighbor is resynced.
+        self.drained_routes = {}
+        return
+
+    def ready(self) :
+        return self.queue and not self.paused
+
+    def stats(self) :
+
+        return {
+            "queue_depth" : len(self.queue),
+            "queue_peak" : self.queue_peak,
+            "routes_per_second" : self.bucket.rate,
+            "routes_written" : self.routes_written,
+            "paused" : self.paused,
+            "drained" : self.drained,
+        }
+
+
+class ExaBGPWriter :
+    """ owner of the pipe to exabgp (stdout).
+
+    Commands are queued for each neighbor, and a writer thread takes
+    commands from the queues in turn and coalesces them into large
+    writes, at most routes_per_second commands per second in total and
+    at most the limit of each neighbor (0 means no limit). When more
+    than max_queue commands are queued to a neighbor, write() blocks
+    until the writer thread catches up (backpressure), unless the queue
+    is paused. Before start(), commands are written synchronously.
+
+    Commands are numbered in the order written. If track_acks is True,
+    written commands are kept in self.unacked until ExaBGPReader
+    receives their acknowledgements from exabgp, in the same order.
+    """
+
+    def __init__(self, out = None, routes_per_second = 0,
+                 max_queue = 100000, batch = 1024,
+                 neighbor_routes_per_second = 0) :
+        """
+        @out: file object to write commands, sys.stdout if None
+        """
+        self.out = out
+        self.bucket = TokenBucket(routes_per_second)
+        self.neighbor_routes_per_second = neighbor_routes_per_second
+        self.max_queue = max_queue
+        self.batch = batch
+
+        self.neighbors = {} # key: neighbor address, value: NeighborQueue
+        self.cond = threading.Condition()
+        self.thread = None
+        self.inflight = 0
+        self.turn = 0 # the neighbor taken first
+        self.wait = 0 # seconds to wait for tokens
+
+        self.position = 0 # number of commands queued so far
+        self.track_acks = False
+        self.unacked = collections.deque() # (NeighborQueue, command)
+
+        # statistics
+        self.queue_peak = 0
+        self.routes_written = 0
+        self.writes = 0
+        self.blocked = 0 # number of writers waiting for space now
+        self.backpressure_events = 0
+        self.backpressure_seconds = 0.0
+        return
+
+    @property
+    def routes_per_second(self) :
+        return self.bucket.rate
+
+    @routes_per_second.setter
+    def routes_per_second(self, rate) :
+        self.bucket.rate = rate
+
+    def start(self) :
+
+        if self.thread :
+            return
+        self.thread = threading.Thread(target = self.run,
+                                       name = "exabgp-writer",
+                                       daemon = True)
+        self.thread.start()
+        return
+
+    def output(self) :
+        return self.out if self.out else sys.stdout
+
+    def neighbor(self, address) :
+        """ NeighborQueue of the address. called with self.cond held """
+
+        q = self.neighbors.get(address)
+        if not q :
+            q = NeighborQueue(address, self.neighbor_routes_per_second)
+            self.neighbors[address] = q
+        return q
+
+    def depth(self) :
+        return sum([len(q.queue) for q in self.neighbors.values()])
+
+    def ready(self) :
+        """ queues of neighbors having commands to be written """
+        return [q for q in self.neighbors.values() if q.ready()]
+
+    def full(self, queues) :
+        for q in queues :
+            if len(q.queue) >= self.max_queue and not q.paused :
+                return True
+        return False
+
+    def write(self, cmds) :
+        """ queue exabgp commands. commands to a neighbor are written in
+        the order queued, and commands given at once are never
+        interleaved with commands to the neighbor from other write()
+        calls, while commands to different neighbors may be reordered.
+        returns the number of the last command queued so far.
+        """
+
+        if not cmds :
+            return self.position
+
+        start = time.perf_counter()
+
+        # commands to each neighbor in order
+        groups = {}
+        announces = 0
+        for cmd in cmds :
+            x = cmd.index(" ", 9)
+            address = cmd[9:x] # see route_neighbor
+            if cmd.startswith("announce", x + 1) :
+                announces += 1
+            group = groups.get(address)
+            if group is None :
+                group = groups[address] = []
+            group.append(cmd)
+
+        metrics.inc("flowchain_exabgp_commands_total",
+                    (("action", "announce"),), announces)
+        metrics.inc("flowchain_exabgp_commands_total",
+                    (("action", "withdraw"),), len(cmds) - announces)
+
+        with self.cond :
+            runs = [(self.neighbor(address), group)
+                    for address, group in groups.items()]
+
+            if not self.thread :
+                self.number(runs)
+                self.emit(runs)
+                for q, run in runs :
+                    q.routes_written += len(run)
+                self.routes_written += len(cmds)
+                self.writes += 1
+                metrics.observe("flowchain_exabgp_write_seconds",
+                                time.perf_counter() - start)
+                return self.position
+
+            queues = set([q for q, run in runs])
+            if self.full(queues) :
+                self.blocked += 1
+                self.backpressure_events += 1
+                blocked_start = time.monotonic()
+                while self.full(queues) :
+                    self.cond.wait()
+                self.backpressure_seconds += (time.monotonic() -
+                                              blocked_start)
+                self.blocked -= 1
+
+            self.number(runs)
+            for q, run in runs :
+                q.queue.extend(run)
+                if len(q.queue) > q.queue_peak :
+                    q.queue_peak = len(q.queue)
+
+            depth = self.depth()
+            if depth > self.queue_peak :
+                self.queue_peak = depth
+            self.cond.notify_all()
+
+        metrics.observe("flowchain_exabgp_write_seconds",
+                        time.perf_counter() - start)
+        return self.position
+
+    def number(self, runs) :
+        """ number commands in runs. called with self.cond held """
+
+        for q, run in runs :
+            if self.track_acks :
+                q.outstanding.extend(range(self.position + 1,
+                                           self.position + len(run) + 1))
+            if q.drained_routes :
+                # routes written again are not lost any more
+                for cmd in run :
+                    q.drained_routes.pop(command_nlri(cmd), None)
+            self.position += len(run)
+        return
+
+    def emit(self, runs) :
+        """ @runs: list of (NeighborQueue, list of commands) """
+
+        if self.track_acks :
+            # before writing, acks may arrive before write() returns
+            for q, run in runs :
+                self.unacked.extend([(q, cmd) for cmd in run])
+        out = self.output()
+        out.write("".join(["".join(["%s\n" % cmd for cmd in run])
+                           for q, run in runs]))
+        out.flush()
+        return
+
+    def take(self) :
+        """ dequeue commands allowed to be written now, from queues of
+        neighbors in turn, as runs of emit(). called with self.cond
+        held. returns [] and sets self.wait if must wait for tokens.
+        """
+
+        ready = self.ready()
+        if not ready :
+            self.wait = None
+            return []
+
+        now = time.monotonic()
+        pending = sum([len(q.queue) for q in ready])
+        limit = self.bucket.allow(min(pending, self.batch), now)
+        if not limit :
+            self.wait = self.bucket.wait
+            return []
+
+        self.turn = (self.turn + 1) % len(ready)
+        ready = ready[self.turn:] + ready[:self.turn]
+        share = max(1, limit // len(ready))
+
+        runs = []
+        taken = 0
+        self.wait = None
+        for q in ready :
+            if taken == limit :
+                break
+            n = min(len(q.queue), share, limit - taken)
+            n = q.bucket.allow(n, now)
+            if not n :
+                if self.wait is None or q.bucket.wait < self.wait :
+                    self.wait = q.bucket.wait
+                continue
+            q.bucket.consume(n)
+            runs.append((q, [q.queue.popleft() for x in range(n)]))
+            taken += n
+
+        self.bucket.consume(taken)
+        return runs
+
+    def run(self) :
+
+        while True :
+            with self.cond :
+                while not self.ready() :
+                    self.cond.wait()
+
+                runs = self.take()
+                if not runs :
+                    self.cond.wait(self.wait)
+                    continue
+                self.inflight = sum([len(run) for q, run in runs])
+                self.cond.notify_all()
+
+            try :
+                self.emit(runs)
+            except Exception as e :
+                logger.error("ERROR: failed to write to exabgp: %s" % e)
+
+            with self.cond :
+                for q, run in runs :
+                    q.routes_written += len(run)
+                self.routes_written += self.inflight
+                self.inflight = 0
+                self.writes += 1
+                self.cond.notify_all()
+
+    def flush(self, timeout = None) :
+        """ wait until all queued commands, except for paused
+        neighbors, are written
+        """
+
+        with self.cond :
+            return self.cond.wait_for(lambda : (not self.ready() and
+                                                not self.inflight),
+                                      timeout)
+
+    def acked(self) :
+        """ remove the oldest unacked command on its acknowledgement.
+        returns the command, or None if no command is unacked.
+        """
+
+        with self.cond :
+            if not self.unacked :
+                return None
+            q, cmd = self.unacked.popleft()
+            q.outstanding.popleft()
+            return cmd
+
+    def acked_through(self, address) :
+        """ number of the last command such that all commands to the
+        neighbor up to it are acknowledged.
+        """
+
+        position = self.position
+        q = self.neighbors.get(address)
+        if q is None :
+            return position
+        try :
+            return q.outstanding[0] - 1
+        except IndexError :
+            return position
+
+    def drained(self, address, nlri) :
+        """ True if the last command announcing the NLRI to the
+        neighbor is drained, and the route is not written again since.
+        """
+
+        q = self.neighbors.get(address)
+        return q is not None and nlri in q.drained_routes
+
+    def resynced(self, address, position) :
+        """ routes of the neighbor are written again up to position """
+
+        with self.cond :
+            q = self.neighbors.get(address)
+            if q :
+                q.drained_routes = dict([(nlri, number) for nlri, number
+                                         in q.drained_routes.items()
+                                         if number > position])
+        return
+
+    def pause(self, address, paused = True) :
+        """ hold (or release) commands to the neighbor in its queue """
+
+        with self.cond :
+            self.neighbor(address).paused = paused
+            self.cond.notify_all()
+        return
+
+    def drain(self, address) :
+        """ discard commands queued to the neighbor. returns the number
+        of discarded commands.
+        """
+
+        with self.cond :
+            q = self.neighbor(address)
+            n = len(q.queue)
+            if self.track_acks :
+                numbers = [q.outstanding.pop() for x in range(n)]
+                numbers.reverse()
+            else :
+                numbers = [self.position] * n
+            for cmd, number in zip(q.queue, numbers) :
+                if cmd.startswith("announce ", cmd.index(" ", 9) + 1) :
+                    q.drained_routes[command_nlri(cmd)] = number
+            q.queue.clear()
+            q.drained += n
+            self.cond.notify_all()
+        return n
+
+    def set_rate(self, address, routes_per_second) :
+
+        with self.cond :
+            self.neighbor(address).bucket.rate = routes_per_second
+            self.cond.notify_all()
+        return
+
+    def neighbor_stats(self, address) :
+
+        with self.cond :
+            q = self.neighbors.get(address)
+            return q.stats() if q else NeighborQueue(address).stats()
+
+    def stats(self) :
+
+        with self.cond :
+            return {
+                "queue_depth" : self.depth() + self.inflight,
+                "queue_peak" : self.queue_peak,
+                "max_queue" : self.max_queue,
+                "routes_per_second" : self.bucket.rate,
+                "routes_written" : self.routes_written,
+                "writes" : self.writes,
+                "backpressure" : self.blocked > 0,
+                "backpressure_events" : self.backpressure_events,
+                "backpressure_seconds" : self.backpressure_seconds,
+                "unacked" : len(self.unacked),
+                "neighbors" : dict([(q.address, q.stats())
+                                    for q in self.neighbors.values()]),
+            }
+
+writer = ExaBGPWriter()
+
+metrics.describe("flowchain_exabgp_commands_total", "counter",
+                 "announce and withdraw commands queued to exabgp")
+metrics.describe("flowchain_exabgp_write_seconds", "histogram",
+                 "ExaBGPWriter.write including waits for backpressure")
+
+
+READER_LINE_LIMIT = 1048576 # max length of a message from exabgp
+
+
+class ExaBGPReader :
+    """ reader of messages from exabgp (stdin) on the asyncio event
+    loop of ControlPlane.
+
+    Neighbor state changes ("type": "state" of the JSON encoder) are
+    tracked for each neighbor, and "done" or "error" acknowledges the
+    oldest unacked command of the writer. When a neighbor becomes up
+    again, on_established(address) is called on another thread to
+    replay the routes of the neighbor.
+    """
+
+    def __init__(self, inp = None) :
+        """
+        @inp: file object to read messages, sys.stdin if None
+        """
+        self.inp = inp
+        self.running = False
+        self.lock = threading.Lock()
+        self.on_established = None
+
+        # key: peer address, value: dict of the session state
+        self.neighbors = {}
+
+        self.acks = 0 # number of acknowledged commands
+        self.errors = 0 # number of commands exabgp failed
+        self.failed = {} # key: NLRI of failed announce, value: command
+
+        # incremented on every change of the status of routes
+        self.version = 0
+        return
+
+    def start(self, control) :
+        """ start to read messages on the loop of ControlPlane """
+
+        if self.running :
+            return
+        self.running = True
+        control.spawn(self.read(control.loop))
+        return
+
+    async def read(self, loop) :
+
+        inp = self.inp if self.inp else sys.stdin
+        stream = asyncio.StreamReader(limit = READER_LINE_LIMIT)
+        protocol = asyncio.StreamReaderProtocol(stream)
+
+        try :
+            await loop.connect_read_pipe(lambda : protocol, inp)
+        except (OSError, ValueError) as e :
+            log.error("Failed to read messages from exabgp: %s" % e)
+            return
+
+        while True :
+            try :
+                line = await stream.readline()
+            except ValueError as e :
+                log.warn("Ignore a message from exabgp: %s" % e)
+                continue
+            if not line :
+                break
+
+            line = line.decode(errors = "replace").strip()
+            try :
+                self.handle(line)
+            except Exception as e :
+                logger.error("ERROR: failed to handle message %s: %s" %
+                             (line, e))
+
+        log.warn("exabgp closed the pipe")
+        return
+
+    def handle(self, line) :
+
+        if not line :
+            return
+
+        if line in ("done", "error") :
+            self.ack(line == "done")
+            return
+
+        try :
+            msg = json.loads(line)
+        except ValueError :
+            log.warn("Unknown message from exabgp: %s" % line)
+            return
+
+        if not isinstance(msg, dict) :
+            return
+
+        if msg.get("answer") in ("done", "error") :
+            self.ack(msg["answer"] == "done")
+
+        elif msg.get("type") == "state" :
+            neighbor = msg.get("neighbor", {})
+            address = neighbor.get("address", {}).get("peer")
+            state = neighbor.get("state")
+            if address and state :
+                self.change_state(address, state, neighbor.get("reason"))
+
+        return
+
+    def ack(self, done) :
+
+        cmd = writer.acked()
+        if cmd is None :
+            log.warn("Acknowledgement for no command from exabgp")
+            return
+
+        nlri = None
+        if not done or self.failed :
+            nlri = route_nlri(cmd.replace(" announce ", " UPDATE ", 1)
+                              .replace(" withdraw ", " UPDATE ", 1))
+
+        with self.lock :
+            self.acks += 1
+            self.version += 1
+            if done :
+                if nlri :
+                    self.failed.pop(nlri, None)
+                return
+            self.errors += 1
+            if " announce " in cmd :
+                self.failed[nlri] = cmd
+
+        log.warn("exabgp failed: %s" % cmd)
+        return
+
+    def change_state(self, address, state, reason = None) :
+
+        with self.lock :
+            peer = self.neighbors.get(address)
+            if not peer :
+                peer = { "state" : None, "since" : None, "established" : 0,
+                         "replayed" : 0 }
+                self.neighbors[address] = peer
+
+            if peer["state"] == state :
+                return
+
+            peer["state"] = state
+            peer["since"] = time.time()
+            self.version += 1
+
+            replay = False
+            if state == "up" :
+                peer["established"] += 1
+                replay = peer["established"] > 1
+                if replay :
+                    peer["replayed"] = None # until replayed() is called
+
+        log.info("Neighbor %s is %s%s" %
+                 (address, state, " (%s)" % reason if reason else ""))
+
+        if replay and self.on_established :
+            # not on this thread, which must keep reading acks while
+            # the routes are written.
+            threading.Thread(target = self.on_established,
+                             args = (address,), daemon = True).start()
+        return
+
+    def drained(self, address) :
+        """ routes queued to the neighbor are discarded, and they are
+        pending until replayed (see route_status)
+        """
+
+        with self.lock :
+            self.version += 1
+        return
+
+    def replayed(self, address, position) :
+        """ routes of the neighbor are written up to position """
+
+        with self.lock :
+            peer = self.neighbors.get(address)
+            if peer :
+                peer["replayed"] = position
+                self.version += 1
+        return
+
+    def route_status(self, route, written) :
+        """ "installed", "pending" or "failed".
+        @route: route with UPDATE placeholder
+        @written: number of the last command announcing the route
+        """
+
+        if self.failed and route_nlri(route) in self.failed :
+            return "failed"
+
+        address = route_neighbor(route)
+        peer = self.neighbors.get(address)
+        if (not peer or peer["state"] != "up" or
+            peer["replayed"] is None or
+            writer.acked_through(address) < max(written, peer["replayed"])) :
+            return "pending"
+
+        # the last announce of the route is drained until resync
+        if writer.drained(address, route_nlri(route)) :
+            return "pending"
+
+        return "installed"
+
+    def neighbor_state(self, address) :
+        """ session state of a neighbor, None if not received yet """
+
+        with self.lock :
+            peer = self.neighbors.get(address, {})
+            return {
+                "state" : peer.get("state"),
+                "since" : peer.get("since"),
+                "established" : peer.get("established", 0),
+            }
+
+    def stats(self, neighbors = []) :
+        """ @neighbors: addresses of configured neighbors, shown even if
+        no state is received yet.
+        """
+
+        peers = {}
+        for address in list(neighbors) + list(self.neighbors) :
+            peers[address] = self.neighbor_state(address)
+
+        with self.lock :
+            return {
+                "neighbors" : peers,
+                "acks" : self.acks,
+                "errors" : self.errors,
+                "failed_routes" : len(self.failed),
+                "unacked" : len(writer.unacked),
+            }
+
+reader = ExaBGPReader()
+
+
+class RouteTable :
+    """ reference counts of routes announced to exabgp. a route is
+    announced when its count goes 0 to 1, and withdrawn only when it
+    goes 1 to 0, so that routes shared by TOS flows and flows are not
+    announced twice nor withdrawn while still in use.
+
+    counts has routes, in the "UPDATE" form, referenced by TOS flows.
+    routes of flows are not stored: the prefixes of flows are unique
+    in the RIB and every route of a flow matches its prefix, so that a
+    flow holds the only flow reference to each of its routes, and it
+    is counted by the flow in the RIB (see RoutingInformationBase.
+    route_owner). callers change counts holding rib.lock for writing,
+    or before the RIB serves requests.
+    """
+
+    def __init__(self) :
+        self.counts = {} # key: route, value: number of references
+        self.suppressed = 0 # commands not written as routes are shared
+        return
+
+    def owned(self, route) :
+        return rib is not None and rib.route_owner(route) is not None
+
+    def unshared(self, routes, counts = None) :
+        """ routes of a flow which are not referenced in this table. the
+        others are kept announced by the table when the flow adds or
+        removes its reference.
+        @counts: counts used instead of this table for dry runs
+        """
+        dry = counts is not None
+        if not dry :
+            counts = self.counts
+        if not counts :
+            return routes
+        unshared = [r for r in routes if not r in counts]
+        if not dry :
+            self.suppressed += len(routes) - len(unshared)
+        return unshared
+
+    def flow_commands(self, flow, action, counts = None) :
+        """ exabgp commands to announce or withdraw the routes of a flow
+        which are not shared with this table.
+        """
+        eroutes, iroutes = flow.routes()
+        return [r.replace("UPDATE", action)
+                for r in self.unshared(eroutes + iroutes, counts)]
+
+    def update(self, added, removed, counts = None) :
+        """ add a reference to each route of added, and remove a
+        reference from each route of removed. returns (routes to be
+        announced, routes to be withdrawn): routes whose count goes 0 to
+        1, and 1 to 0, unless a flow in the RIB has the route. as
+        route_delta(), a route is not withdrawn if a route of added
+        having the same NLRI replaces it.
+        @counts: counts changed instead of this table for dry runs
+        """
+
+        dry = counts is not None
+        if not dry :
+            counts = self.counts
+
+        delta = {}
+        for r in added :
+            delta[r] = delta.get(r, 0) + 1
+        for r in removed :
+            delta[r] = delta.get(r, 0) - 1
+
+        newnlris = set([route_nlri(r) for r in added])
+        announced = []
+        withdrawn = []
+
+        for r, n in delta.items() :
+            before = counts.get(r, 0)
+            after = max(before + n, 0)
+            if after :
+                counts[r] = after
+            elif before :
+                del(counts[r])
+
+            written = 0
+            if not before and after and not self.owned(r) :
+                announced.append(r)
+                written = 1
+            elif before and not after and not self.owned(r) :
+                if not route_nlri(r) in newnlris :
+                    withdrawn.append(r)
+                written = 1
+            if not dry :
+                self.suppressed += abs(n) - written
+
+        return announced, withdrawn
+
+    def settle(self, announced, withdrawn) :
+        """ drop routes both to be announced and withdrawn from the
+        lists, which moved between flows and this table and stay
+        announced. returns (announced, withdrawn).
+        """
+        moved = set(announced).intersection(withdrawn)
+        if not moved :
+            return announced, withdrawn
+        return ([r for r in announced if not r in moved],
+                [r for r in withdrawn if not r in moved])
+
+    def stats(self) :
+        return {
+            "routes" : len(self.counts),
+            "references" : sum(self.counts.values()),
+            "suppressed" : self.suppressed,
+        }
+
+route_table = RouteTable()
+
+
 CONFIG_JSON = os.path.join(os.path.dirname(__file__), 'config.json')
+config_path = CONFIG_JSON # config file loaded by main(), and reloaded
+JOURNAL = os.path.join(os.path.dirname(__file__), 'flowchain.journal')
 
 
 class Function :
 
+    __slots__ = ("name", "rdtop", "rdbot", "marktop", "markbot", "cgn",
+                 "fp")
+
     def __init__(self, name, rdtop, rdbot, marktop, markbot,  cgn) :
         self.name = name
         self.rdtop = rdtop
@@ -59,6 +1092,9 @@ class Function :
 
 class FunctionPool :
 
+    __slots__ = ("name", "community", "neighbor", "functions",
+                 "inter_fp_rd", "user_vrf_rd", "pools")
+
     def __init__(self, name, community, neighbor) :
         self.name = name
         self.community = community
@@ -69,6 +1105,7 @@ class FunctionPool :
             "private" : {},
         }
         self.user_vrf_rd = {} # key: global/private, value:rd
+        self.pools = None # FunctionPools which this FP belongs to
         return
 
     def __eq__(self, other) :
@@ -82,8 +1119,12 @@ class FunctionPool :
         if fn.name in self.functions :
             raise RuntimeError('Duplicated Function "%s" in %s',
                                fn.name, self.name)
+        if self.pools :
+            self.pools.check_name(fn.name, self)
         self.functions[fn.name] = fn
         fn.fp = self
+        if self.pools :
+            self.pools.index_fp(self)
         return
 
 
@@ -100,12 +1141,18 @@ class FunctionPool :
             raise RuntimeError('Duplicated Inter FP RD "%s" in %s',
                                rd, self.name)
         self.inter_fp_rd[slicename][fpname] = rd
+        if self.pools :
+            self.pools.invalidate_chain_cache()
         return
 
 
     def add_user_vrf_rd(self, vrfname, rd) :
 
+        if self.pools and not vrfname in self.user_vrf_rd :
+            self.pools.check_name(vrfname, self)
         self.user_vrf_rd[vrfname] = rd
+        if self.pools :
+            self.pools.index_fp(self)
         return
     
 class FunctionPools :
@@ -115,43 +1162,227 @@ class FunctionPools :
         """"
         @fps: list of FunctionPool
         """
-        self.fps = fps
+        self.fps = []
+        self.fn_index = {} # key: fn.name, value: class Function
+        self.fp_index = {} # key: fn.name or user vrf name, value: class FP
+        self.vrf_rd_index = {} # key: user vrf name, value: rd
+
+        # key: (start, tuple of chain, NAT-presence), value: ChainTemplate
+        self.chain_cache = {}
+        self.chain_cache_hits = 0
+        self.chain_cache_misses = 0
+        # the cache is changed by readers of the RIB, such as /plan, too
+        self.chain_cache_lock = threading.Lock()
+
+        # TOS flows announced now.
+        # key: (fp name, peer fp name, fn name, slice),
+        # value: (eroutes, iroutes) of "UPDATE" routes.
+        self.tos_announced = {}
+
+        for fp in fps :
+            self.add_fp(fp)
         return
 
     def add_fp(self, fp) :
+
+        if fp in self.fps :
+            raise RuntimeError('Duplicated Function Pool "%s"' % fp.name)
+
+        # check all names before touching the indexes, so that a
+        # broken FP does not leave the indexes half updated.
+        names = list(fp.functions.keys()) + list(fp.user_vrf_rd.keys())
+        if len(names) != len(set(names)) :
+            raise RuntimeError('Function and user VRF share a name in %s' %
+                               fp.name)
+        for name in names :
+            self.check_name(name, fp)
+
         self.fps.append(fp)
+        self.index_fp(fp)
+        fp.pools = self
+        return
+
+    def check_name(self, name, fp) :
+        """ function and user vrf names must be unique across all FPs """
+
+        if name in self.fp_index :
+            raise RuntimeError('Duplicated name "%s" in %s and %s' %
+                               (name, self.fp_index[name].name, fp.name))
+        return
+
+    def index_fp(self, fp) :
+
+        self.invalidate_chain_cache()
+
+        for fnname, fn in fp.functions.items() :
+            self.fn_index[fnname] = fn
+            self.fp_index[fnname] = fp
+
+        for vrfname, rd in fp.user_vrf_rd.items() :
+            self.vrf_rd_index[vrfname] = rd
+            self.fp_index[vrfname] = fp
         return
 
     def find_rd_of_user_vrf(self, vrfname) :
+        return self.vrf_rd_index.get(vrfname)
 
-        for fp in self.fps :
-            for vn, rd in fp.user_vrf_rd.items() :
-                if vn == vrfname :
-                    return rd
-        return None
-            
     def find_fp_by_name(self, name) :
+        """ @name: function name or user vrf name """
+        return self.fp_index.get(name)
 
-        for fp in self.fps :
+    def find_function_by_name(self, fnname) :
+        return self.fn_index.get(fnname)
+
+    def invalidate_chain_cache(self) :
+        with self.chain_cache_lock :
+            self.chain_cache.clear()
+        return
 
-            # check user-vrf
-            for vn in fp.user_vrf_rd :
-                if vn == name :
-                    return fp
+    def compile_chain(self, start, chain, has_nat) :
+        """ returns ChainTemplate of the chain from the start user vrf,
+        or None if the chain cannot be encoded.
+        """
 
-            # check function name
-            for fnname in fp.functions :
-                if fnname == name :
-                    return fp
+        key = (start, tuple(chain), has_nat)
+        with self.chain_cache_lock :
+            template = self.chain_cache.get(key)
+            if template :
+                self.chain_cache_hits += 1
+                return template
+            self.chain_cache_misses += 1
 
-        return None
+        routes = self.encode_chain(start, chain, has_nat)
+        if not routes :
+            return None
 
-    def find_function_by_name(self, fnname) :
+        eroutes, iroutes = routes
+        template = ChainTemplate(start, list(chain), eroutes, iroutes)
+        with self.chain_cache_lock :
+            # keep the template of a concurrent compile of the chain
+            return self.chain_cache.setdefault(key, template)
+
+    def encode_chain(self, start, chain, has_nat) :
+        """ returns (eroutes, iroutes) of the chain encoded with
+        ChainTemplate.PREFIX and NATTED, or False.
+        """
+
+        prefix_natted = ChainTemplate.NATTED if has_nat else None
+        f = Flow(start, list(chain), ChainTemplate.PREFIX, prefix_natted)
+        return f.encode_routes(self)
+
+    def compile_chains(self, keys, workers = 1) :
+        """ compile templates of keys, (start, tuple of chain, has_nat),
+        missing in the chain cache on worker processes. each worker has
+        a snapshot of this FunctionPools and returns the routes of its
+        shard of the keys, and the templates are cached in the order of
+        the keys. chains that cannot be encoded are left to
+        compile_chain. returns the number of compiled templates.
+        """
+
+        with self.chain_cache_lock :
+            missing = list(dict.fromkeys([key for key in keys
+                                          if not key in self.chain_cache]))
+        if workers < 2 or len(missing) < COMPILE_PARALLEL_MIN :
+            return 0
+
+        size = -(-len(missing) // (workers * 4))
+        shards = [missing[x:x + size] for x in range(0, len(missing), size)]
+
+        compiled = 0
+        context = multiprocessing.get_context("spawn")
+        try :
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context = context,
+                    initializer = init_compile_worker,
+                    initargs = (self,)) as pool :
+                for shard, results in zip(shards,
+                                          pool.map(compile_chains_worker,
+                                                   shards)) :
+                    for key, routes in zip(shard, results) :
+                        if not routes :
+                            continue
+                        eroutes, iroutes = routes
+                        template = ChainTemplate(key[0], list(key[1]),
+                                                 eroutes, iroutes)
+                        with self.chain_cache_lock :
+                            self.chain_cache.setdefault(key, template)
+                        compiled += 1
+        except (OSError, concurrent.futures.BrokenExecutor) as e :
+            # the rest is compiled by compile_chain
+            log.warn("Failed to compile chains on processes: %s" % e)
+
+        with self.chain_cache_lock :
+            self.chain_cache_misses += compiled
+        log.info("Compiled %d chains on %d processes" % (compiled, workers))
+        return compiled
+
+    def __getstate__(self) :
+        # a snapshot for worker processes of compile_chains, without
+        # the chain cache.
+        state = self.__dict__.copy()
+        state["chain_cache"] = {}
+        del(state["chain_cache_lock"])
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self.chain_cache_lock = threading.Lock()
+        return
+
+    def chain_cache_stats(self) :
+
+        with self.chain_cache_lock :
+            hits = self.chain_cache_hits
+            misses = self.chain_cache_misses
+            entries = len(self.chain_cache)
+
+        lookups = hits + misses
+        return {
+            "entries" : entries,
+            "hits" : hits,
+            "misses" : misses,
+            "hit_rate" : hits / lookups if lookups else 0.0,
+        }
+
+    def describe(self) :
+        """ attributes of function pools, functions and user VRFs.
+        returns dict of kind: dict of name: attributes.
+        """
+
+        pools = {}
+        functions = {}
+        vrfs = {}
 
         for fp in self.fps :
-            if fnname in fp.functions :
-                return fp.functions[fnname]
-        return None
+            pools[fp.name] = (fp.community, fp.neighbor, fp.inter_fp_rd)
+            for fn in fp.functions.values() :
+                functions[fn.name] = (fn.rdtop, fn.rdbot, fn.marktop,
+                                      fn.markbot, fn.cgn, fp.name)
+            for vrfname, rd in fp.user_vrf_rd.items() :
+                vrfs[vrfname] = (rd, fp.name)
+
+        return { "pool" : pools, "function" : functions, "user_vrf" : vrfs }
+
+    def diff(self, other) :
+        """ names of function pools, functions and user VRFs added,
+        removed or changed in other FunctionPools.
+        """
+
+        old = self.describe()
+        new = other.describe()
+        result = {}
+
+        for kind in old :
+            o = old[kind]
+            n = new[kind]
+            result[kind] = {
+                "added" : sorted([name for name in n if not name in o]),
+                "removed" : sorted([name for name in o if not name in n]),
+                "changed" : sorted([name for name in n
+                                    if name in o and n[name] != o[name]]),
+            }
+
+        return result
 
     def find_inter_fp_rd(self, fp_from, fp_to, is_private) :
 
@@ -166,127 +1397,357 @@ class FunctionPools :
         return inter_fp_rd[fp_to.name]
 
 
-    def generate_tos_flows(self) :
+    def tos_keys(self, pools = None) :
+        """ generate keys of TOS flows, (fp, efp, fn, slicename), for
+        each function fn of fp, peer fp efp, and slice "global" or
+        "private".
+        @pools: if given, only keys whose fp or efp is in pools
+        """
 
-        eroutes = []
-        iroutes = []
+        for slicename in ("global", "private") :
+            for fp in self.fps :
+                for fn in fp.functions.values() :
+                    for efp in self.fps :
+                        if efp == fp : continue
+                        if (pools is not None and
+                            not fp in pools and not efp in pools) :
+                            continue
+                        yield (fp, efp, fn, slicename)
+
+    def tos_routes(self, key, action = "announce") :
+        """ returns (eroutes, iroutes), commands of TOS flows of a key
+        for Egress and Ingress.
+        @action: "announce", "withdraw", or "UPDATE" for routes
+        """
 
-        flowfmt4 = ("neighbor {neighbor} "
-                    + "announce flow route {{ "
-                    + "rd {rd}; "
-                    + "match {{ destination 0.0.0.0/0; dscp {mark}; }} "
-                    + "then {{"
-                    + "community [{community}]; "
-                    + "extended-community target:{rd}; "
-                    + "redirect {redirect}; "
-                    + "}} }}")
-
-        flowfmt6 = ("neighbor {neighbor} "
-                    + "announce flow route {{ "
-                    + "rd {rd}; "
-                    + "match {{ destination 0::0/0; dscp {mark}; }} "
-                    + "then {{"
-                    + "community [{community}]; "
-                    + "extended-community target:{rd}; "
-                    + "redirect {redirect}; "
-                    + "}} }}")
-
-
-        # Global
-        for fp in self.fps :
-            for fnname, fn in fp.functions.items() :
-                for efp in self.fps :
-                    if efp == fp : continue
-                    interfp_rd = self.find_inter_fp_rd(efp, fp, False)
-                    eroute4 = flowfmt4.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.markbot,
-                                              community = fp.community,
-                                              redirect = fn.rdbot)
-                    eroute6 = flowfmt6.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.markbot,
-                                              community = fp.community,
-                                              redirect = fn.rdbot)
-                    eroutes.append(eroute4)
-                    eroutes.append(eroute6)
-
-                    iroute4 = flowfmt4.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.marktop,
-                                              community = fp.community,
-                                              redirect = fn.rdtop)
-                    iroute6 = flowfmt6.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.marktop,
-                                              community = fp.community,
-                                              redirect = fn.rdtop)
-                    iroutes.append(iroute4)
-                    iroutes.append(iroute6)
-
-        # Private
-        for fp in self.fps :
-            for fnname, fn in fp.functions.items() :
-                for efp in self.fps :
-                    if efp == fp : continue
-                    interfp_rd = self.find_inter_fp_rd(efp, fp, True)
-                    eroute4 = flowfmt4.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.markbot,
-                                              community = fp.community,
-                                              redirect = fn.rdbot)
-                    eroute6 = flowfmt6.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.markbot,
-                                              community = fp.community,
-                                              redirect = fn.rdbot)
-                    eroutes.append(eroute4)
-                    eroutes.append(eroute6)
-
-                    iroute4 = flowfmt4.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.marktop,
-                                              community = fp.community,
-                                              redirect = fn.rdtop)
-                    iroute6 = flowfmt6.format(neighbor = fp.neighbor,
-                                              rd = interfp_rd,
-                                              mark = fn.marktop,
-                                              community = fp.community,
-                                              redirect = fn.rdtop)
-                    iroutes.append(iroute4)
-                    iroutes.append(iroute6)
-
-
-
-        for route in eroutes :
-            logger.info("announce inter-fp TOS flow routes for Egress.")
-            sys.stdout.write("%s\n" % route)
-            sys.stdout.flush()
-
-        for route in iroutes :
-            logger.info("announce inter-fp TOS flow routes for Ingress.")
-            sys.stdout.write("%s\n" % route)
-            sys.stdout.flush()
+        fp, efp, fn, slicename = key
 
+        flowfmt = ("neighbor {neighbor} "
+                   + "{action} flow route {{ "
+                   + "rd {rd}; "
+                   + "match {{ destination {default}; dscp {mark}; }} "
+                   + "then {{"
+                   + "community [{community}]; "
+                   + "extended-community target:{rd}; "
+                   + "redirect {redirect}; "
+                   + "}} }}")
 
-    
-class Flow :
+        interfp_rd = self.find_inter_fp_rd(efp, fp, slicename == "private")
 
-    def __init__(self, start, chain, prefix, prefix_natted) :
+        eroutes = []
+        iroutes = []
+
+        for default in ("0.0.0.0/0", "0::0/0") :
+            eroutes.append(flowfmt.format(action = action,
+                                          neighbor = fp.neighbor,
+                                          rd = interfp_rd,
+                                          default = default,
+                                          mark = fn.markbot,
+                                          community = fp.community,
+                                          redirect = fn.rdbot))
+            iroutes.append(flowfmt.format(action = action,
+                                          neighbor = fp.neighbor,
+                                          rd = interfp_rd,
+                                          default = default,
+                                          mark = fn.marktop,
+                                          community = fp.community,
+                                          redirect = fn.rdtop))
+
+        return eroutes, iroutes
+
+    def tos_key_names(self, key) :
+        """ key of tos_announced for a key of tos_keys() """
+        fp, efp, fn, slicename = key
+        return (fp.name, efp.name, fn.name, slicename)
+
+    def announced_tos_flow_routes(self, action = "announce") :
+        """ returns (eroutes, iroutes) of TOS flows announced now """
+
+        eroutes = []
+        iroutes = []
+
+        for e, i in self.tos_announced.values() :
+            eroutes.extend([r.replace("UPDATE", action) for r in e])
+            iroutes.extend([r.replace("UPDATE", action) for r in i])
+
+        return eroutes, iroutes
+
+    def generate_tos_flows(self, pools = None) :
+        """ announce TOS flows, of or to the pools if given """
+
+        start = time.time()
+
+        eroutes = []
+        iroutes = []
+        oldroutes = [] # routes of keys announced before, replaced now
+        keys = 0
+
+        for key in self.tos_keys(pools) :
+            e, i = self.tos_routes(key, "UPDATE")
+            names = self.tos_key_names(key)
+            if names in self.tos_announced :
+                olde, oldi = self.tos_announced[names]
+                oldroutes.extend(olde + oldi)
+            self.tos_announced[names] = (e, i)
+            eroutes.extend(e)
+            iroutes.extend(i)
+            keys += 1
+
+        # TOS flows of different keys, or flows, may have the same route
+        announced, withdrawn = route_table.update(eroutes + iroutes,
+                                                  oldroutes)
+        egress = set(eroutes)
+        eroutes = [r for r in announced if r in egress]
+        iroutes = [r for r in announced if not r in egress]
+
+        log.info("announce %d inter-fp TOS flow routes for Egress." %
+                 len(eroutes))
+        writer.write([r.replace("UPDATE", "announce") for r in eroutes])
+
+        log.info("announce %d inter-fp TOS flow routes for Ingress." %
+                 len(iroutes))
+        writer.write([r.replace("UPDATE", "announce") for r in iroutes])
+
+        if withdrawn :
+            log.info("withdraw %d replaced inter-fp TOS flow routes." %
+                     len(withdrawn))
+            writer.write([r.replace("UPDATE", "withdraw") for r in withdrawn])
+
+        log.info(("generated %d TOS flow routes of %d (pool, peer-pool, " +
+                  "function, slice) in %.3f seconds") %
+                 (len(eroutes) + len(iroutes), keys, time.time() - start))
+        return
+
+    def take_over_tos_flows(self, other, counts = None) :
+        """ take over TOS flows announced by other FunctionPools, which
+        this replaces. returns (routes to be announced, routes to be
+        withdrawn) to move from the TOS flows of other to these.
+        @counts: changed instead of route_table for dry runs
+        """
+
+        oldroutes = []
+        for e, i in other.tos_announced.values() :
+            oldroutes.extend(e + i)
+
+        newroutes = []
+        for key in self.tos_keys() :
+            e, i = self.tos_routes(key, "UPDATE")
+            self.tos_announced[self.tos_key_names(key)] = (e, i)
+            newroutes.extend(e + i)
+
+        return route_table.update(newroutes, oldroutes, counts)
+
+
+COMPILE_PARALLEL_MIN = 1000 # min chains to compile on worker processes
+compile_worker_fps = None # FunctionPools in a worker of compile_chains
+
+
+def init_compile_worker(fps) :
+
+    global compile_worker_fps
+    compile_worker_fps = fps
+    # errors of chains are reported by compile_chain in the parent
+    logger.setLevel(CRITICAL)
+    return
+
+
+def compile_chains_worker(keys) :
+    """ routes of chains of keys, encoded in a worker process """
+
+    return [compile_worker_fps.encode_chain(start, chain, has_nat)
+            for start, chain, has_nat in keys]
+
+
+class ChainTemplate :
+    """ compiled routes of a chain. each route is (head, tail, natted),
+    and the route of a flow is head + prefix + tail, where prefix is
+    prefix_natted of the flow if natted is True. flows of the chain
+    share the template, and its start and chain.
+    """
+
+    __slots__ = ("start", "chain", "eroutes", "iroutes", "ejson", "ijson",
+                 "json_names", "index_keys", "neighbors")
+
+    PREFIX = "\0prefix\0"
+    NATTED = "\0natted\0"
+
+    def __init__(self, start, chain, eroutes, iroutes) :
+        """
+        @start, @chain: user VRF name and list of function names
+        @eroutes, @iroutes: routes encoded with PREFIX and NATTED
+        """
+        self.start = start
+        self.chain = chain
+        self.eroutes = [self.split(r) for r in eroutes]
+        self.iroutes = [self.split(r) for r in iroutes]
+        self.ejson = [self.split_json(r) for r in self.eroutes]
+        self.ijson = [self.split_json(r) for r in self.iroutes]
+        self.json_names = (json.dumps(chain, separators = (",", ":")),
+                           json.dumps(start))
+        self.index_keys = None # keys of the RIB secondary indexes
+
+        # key: neighbor address, value: routes to the neighbor
+        self.neighbors = {}
+        for route in self.eroutes + self.iroutes :
+            neighbor = route_neighbor(route[0])
+            if not neighbor in self.neighbors :
+                self.neighbors[neighbor] = []
+            self.neighbors[neighbor].append(route)
+        return
+
+    def split(self, route) :
+
+        if self.NATTED in route :
+            head, tail = route.split(self.NATTED)
+            return (head, tail, True)
+        head, tail = route.split(self.PREFIX)
+        return (head, tail, False)
+
+    def split_json(self, route) :
+        """ (head, tail, natted) of a route as JSON string. prefixes do
+        not need escape, so that head + prefix + tail is the JSON
+        string of the route.
+        """
+        head, tail, natted = route
+        return (json.dumps(head)[:-1], json.dumps(tail)[1:], natted)
+
+    def render(self, prefix, prefix_natted) :
+
+        eroutes = [head + (prefix_natted if natted else prefix) + tail
+                   for head, tail, natted in self.eroutes]
+        iroutes = [head + (prefix_natted if natted else prefix) + tail
+                   for head, tail, natted in self.iroutes]
+        return eroutes, iroutes
+
+    def render_json(self, prefix, prefix_natted) :
+        """ (eroutes, iroutes) as JSON arrays """
+
+        eroutes = ",".join([head + (prefix_natted if natted else prefix) +
+                            tail for head, tail, natted in self.ejson])
+        iroutes = ",".join([head + (prefix_natted if natted else prefix) +
+                            tail for head, tail, natted in self.ijson])
+        return "[%s]" % eroutes, "[%s]" % iroutes
+
+    def render_neighbor(self, prefix, prefix_natted, neighbor) :
+        """ routes to the neighbor, egress routes first """
+
+        return [head + (prefix_natted if natted else prefix) + tail
+                for head, tail, natted in self.neighbors.get(neighbor, [])]
+
+
+class Prefix :
+    """ IPv4 or IPv6 prefix parsed from "address/length".
+    version is 4 or 6, network is the network address as an integer,
+    and length is the prefix length. str() is the normalized form.
+    """
+
+    __slots__ = ("version", "network", "length", "text")
+
+    def __init__(self, version, network, length, text = None) :
+        """
+        @text: normalized "address/length" if known
+        """
+
+        self.version = version
+        self.network = network
+        self.length = length
+
+        if text is None :
+            if version == 4 :
+                packed = network.to_bytes(4, "big")
+                address = socket.inet_ntop(socket.AF_INET, packed)
+            else :
+                packed = network.to_bytes(16, "big")
+                address = socket.inet_ntop(socket.AF_INET6, packed)
+            text = "%s/%d" % (address, length)
+
+        self.text = text
+        return
+
+    @classmethod
+    def parse(cls, text) :
+        """ returns Prefix of text. raises ValueError for invalid
+        prefix, and for prefix having host bits.
+        """
+
+        try :
+            address, length = text.split("/")
+        except (AttributeError, ValueError) :
+            raise ValueError("Invalid Prefix '%s'" % text)
+
+        if ":" in address :
+            version, family, width = 6, socket.AF_INET6, 128
+        else :
+            version, family, width = 4, socket.AF_INET, 32
+
+        try :
+            packed = socket.inet_pton(family, address)
+        except OSError :
+            raise ValueError("Invalid Prefix '%s'" % text)
+
+        if not (length.isascii() and length.isdigit()) :
+            raise ValueError("Invalid Prefix '%s'" % text)
+        length = int(length)
+        if length > width :
+            raise ValueError("Invalid IPv%d Prefix '%s'" % (version, text))
+
+        network = int.from_bytes(packed, "big")
+        if network & ((1 << (width - length)) - 1) :
+            raise ValueError("Host bits set in Prefix '%s'" % text)
+
+        # inet_pton accepts only the dotted-quad form for IPv4, so the
+        # address is already normalized.
+        if version == 6 :
+            address = socket.inet_ntop(family, packed)
+
+        return cls(version, network, length, "%s/%d" % (address, length))
+
+    def __eq__(self, other) :
+        return (isinstance(other, Prefix) and
+                self.version == other.version and
+                self.network == other.network and
+                self.length == other.length)
+
+    def __ne__(self, other) :
+        return not self.__eq__(other)
+
+    def __hash__(self) :
+        return hash((self.version, self.network, self.length))
+
+    def __str__(self) :
+        return self.text
+
+
+class Flow :
+    """ routes of a flow are not stored, but rendered from the shared
+    ChainTemplate of its chain when they are announced or shown.
+    """
+
+    __slots__ = ("start", "chain", "prefix", "prefix_natted", "template",
+                 "renders", "seq", "written")
+
+    # views of render() cached in each flow. views including routes are
+    # rendered from the template every time.
+    RENDER_CACHED = ("show", "url")
+
+    def __init__(self, start, chain, prefix, prefix_natted) :
 
         """ 
         @start: user VRF name as a start point
         @chain: list of names of chained Functions
-        @prefix: target user prefix for this chain
+        @prefix: target user prefix for this chain (class Prefix)
         @prefix_natted: it is used as the target prefix after CGN function
+        (class Prefix or None)
         """
 
         self.start = start
         self.chain = chain
         self.prefix = prefix
         self.prefix_natted = prefix_natted
-        self.eroutes = [] # list of egress "flow route" for exabgp
-        self.iroutes = [] # list of ingress "flow route" for exabgp
+        self.template = None # ChainTemplate after encode()
+        self.renders = None # key: view of /show/flow, value: rendering
+        self.seq = 0 # order of insertion into the RIB
+        self.written = 0 # number of the last command announcing routes
         return
 
     def __eq__(self, other) :
@@ -303,6 +1764,26 @@ class Flow :
                                 self.chain)
 
 
+    @property
+    def eroutes(self) :
+        """ list of egress "flow route" for exabgp """
+        return self.routes()[0]
+
+    @property
+    def iroutes(self) :
+        """ list of ingress "flow route" for exabgp """
+        return self.routes()[1]
+
+    def routes(self) :
+        """ (eroutes, iroutes) rendered from the template """
+
+        if not self.template :
+            return [], []
+
+        prefix, prefix_natted = self.prefix_strings()
+        return self.template.render(prefix, prefix_natted)
+
+
     def show(self, extensive = False, html = False) :
 
         fmt = ("Prefix {prefix}\n" +
@@ -316,11 +1797,12 @@ class Flow :
                          chain = " ".join(self.chain))
 
         if extensive :
+            eroutes, iroutes = self.routes()
             out += "    ExaBGP Egress Routes:\n"
-            out += "\n".join(self.eroutes)
+            out += "\n".join(eroutes)
             out += "\n"
             out += "    ExaBGP Ingress Routes:\n"
-            out += "\n".join(self.iroutes)
+            out += "\n".join(iroutes)
             out += "\n"
 
         if html :
@@ -335,9 +1817,9 @@ class Flow :
         fmt = ("/add/{prefix}/{preflen}/{prefix_natted}/{preflen_natted}/" +
                "{start}/{chain_string}")
 
-        prefix, preflen = self.prefix.split("/")
+        prefix, preflen = str(self.prefix).split("/")
         if self.prefix_natted :
-            prefix_natted, preflen_natted = self.prefix_natted.split("/")
+            prefix_natted, preflen_natted = str(self.prefix_natted).split("/")
         else :
             prefix_natted = "none"
             preflen_natted = "none"
@@ -349,19 +1831,121 @@ class Flow :
                           chain_string = "_".join(self.chain))
 
 
-    def json(self) :
+    def prefix_strings(self) :
+        """ (prefix, prefix_natted) as strings, prefix_natted may be None
+        """
+        if self.prefix_natted is None :
+            return str(self.prefix), None
+        return str(self.prefix), str(self.prefix_natted)
+
+
+    def status(self) :
+        """ status of the routes reported by exabgp, see
+        ExaBGPReader.route_status
+        """
+
+        eroutes, iroutes = self.routes()
 
         return {
-            "prefix" : self.prefix,
-            "prefix_natted" : self.prefix_natted,
+            "egress_routes" : [reader.route_status(r, self.written)
+                               for r in eroutes],
+            "ingress_routes" : [reader.route_status(r, self.written)
+                                for r in iroutes],
+        }
+
+
+    def json(self) :
+
+        prefix, prefix_natted = self.prefix_strings()
+        eroutes, iroutes = self.routes()
+
+        out = {
+            "prefix" : prefix,
+            "prefix_natted" : prefix_natted,
             "start" : self.start,
             "chain" : self.chain,
             "exabgp" : {
-                "egress_routes" : self.eroutes,
-                "ingress_routes" : self.iroutes,
+                "egress_routes" : eroutes,
+                "ingress_routes" : iroutes,
             }
         }
 
+        if reader.running :
+            out["status"] = self.status()
+
+        return out
+
+
+    def dumps(self) :
+        """ json() in JSON with sorted keys and without whitespace. the
+        routes are rendered from JSON strings of the template.
+        """
+
+        if not self.template :
+            return json.dumps(self.json(), sort_keys = True,
+                              separators = (",", ":"))
+
+        prefix, prefix_natted = self.prefix_strings()
+        eroutes, iroutes = self.template.render_json(prefix, prefix_natted)
+        chain, start = self.template.json_names
+
+        status = ""
+        if reader.running :
+            status = ',"status":' + json.dumps(self.status(),
+                                               sort_keys = True,
+                                               separators = (",", ":"))
+
+        fmt = ('{"chain":%s,"exabgp":{"egress_routes":%s,' +
+               '"ingress_routes":%s},"prefix":"%s","prefix_natted":%s,' +
+               '"start":%s%s}')
+
+        return fmt % (chain, eroutes, iroutes, prefix,
+                      '"%s"' % prefix_natted if prefix_natted else "null",
+                      start, status)
+
+
+    def render(self, view) :
+        """ rendering of this flow for a view of /show/flow. views in
+        RENDER_CACHED are cached. a flow is never modified after
+        encode(), so the cache is valid while the flow is in the RIB.
+        """
+
+        if self.renders :
+            out = self.renders.get(view)
+            if out is not None :
+                return out
+
+        if view == "show" :
+            out = self.show()
+        elif view == "extensive" :
+            out = self.show(extensive = True)
+        elif view == "url" :
+            out = self.url()
+        elif view == "json" :
+            out = self.dumps()
+        else :
+            raise ValueError("Invalid view '%s'" % view)
+
+        if view in self.RENDER_CACHED :
+            if self.renders is None :
+                self.renders = {}
+            self.renders[view] = out
+        return out
+
+
+    def entry(self, op = "add") :
+        """ bulk entry of this flow, see parse_bulk_entry """
+
+        prefix, prefix_natted = self.prefix_strings()
+
+        return {
+            "op" : op,
+            "prefix" : prefix,
+            "prefix_natted" : prefix_natted,
+            "start" : self.start,
+            "chain" : self.chain,
+        }
+
 
     def is_cgn_included(self, fps) :
         
@@ -376,26 +1960,21 @@ class Flow :
         return False
 
 
+    @metrics.timed("flowchain_flow_validate_seconds",
+                   "seconds of Flow.validate")
     def validate(self, fps) :
         """
-        1. check is prefix correct
+        1. check address families of prefix and prefix_natted
         2. check existence of user vrf
         3. check existence of functions of the chain
         4. check existence of inter-fp-rd
         5. check loop of functions
         """
 
-        if not validate_prefix(self.prefix) :
+        if (self.prefix_natted and
+            self.prefix.version != self.prefix_natted.version) :
+            log.error("Address Family Mismatch between NAT")
             return False
-        if self.prefix_natted and not validate_prefix(self.prefix_natted) :
-            return False
-
-        if self.prefix_natted :
-            before = whichipversion(self.prefix.split("/")[0])
-            after = whichipversion(self.prefix_natted.split("/")[0])
-            if before != after :
-                log.error("Address Family Mismatch between NAT")
-                return False
 
         if not fps.find_rd_of_user_vrf(self.start) :
             log.error("Cannot find user VRF for '%s' for flow %s" %
@@ -445,7 +2024,28 @@ class Flow :
         return True
         
 
+    @metrics.timed("flowchain_flow_encode_seconds",
+                   "seconds of Flow.encode")
     def encode(self, fps) :
+        """ @fps: FunctionPools
+        Encode this flow into exabgp flow routes using the compiled
+        template of the chain cached in fps. the routes are rendered
+        from the template by routes().
+        """
+
+        template = fps.compile_chain(self.start, self.chain,
+                                     self.prefix_natted is not None)
+        if not template :
+            return False
+
+        # share the start and the chain with other flows of the template
+        self.start = template.start
+        self.chain = template.chain
+        self.template = template
+        return True
+
+
+    def encode_routes(self, fps) :
         """ @fps: FunctionPools
         Encode the chain of function names into exabgp flow routes
 
@@ -465,7 +2065,13 @@ class Flow :
 
         all flows have the state { match source self.prefix }.
         Note that after cgn == ture Function, use prefix_natted.
+
+        returns (eroutes, iroutes), lists of egress and ingress routes,
+        or False.
         """
+
+        eroutes = []
+        iroutes = []
         
         flowfmt = ("neighbor {neighbor} "
                    + "UPDATE flow route {{ "
@@ -511,7 +2117,7 @@ class Flow :
                                     prefix = self.prefix,
                                     mark = mark,
                                     redirect = redirect)
-            self.eroutes.append(eroute)
+            eroutes.append(eroute)
 
 
         
@@ -576,8 +2182,8 @@ class Flow :
                                     mark = mark_ingress,
                                     redirect = redirect_ingress)
 
-            self.eroutes.append(eroute)
-            self.iroutes.append(iroute)
+            eroutes.append(eroute)
+            iroutes.append(iroute)
 
 
         # Step 4.
@@ -619,401 +2225,2639 @@ class Flow :
                                         prefix = prefix,
                                         mark = mark,
                                         redirect = inter_fp_rd)
-            self.iroutes.append(iroute)
+            iroutes.append(iroute)
+
+        return eroutes, iroutes
+
+
+    def commands(self, action, neighbor = None) :
+        """ @action: "announce" or "withdraw"
+        @neighbor: if given, only routes to the neighbor
+        returns exabgp commands for all routes of this flow
+        """
+        if neighbor :
+            if not self.template :
+                return []
+            prefix, prefix_natted = self.prefix_strings()
+            routes = self.template.render_neighbor(prefix, prefix_natted,
+                                                   neighbor)
+        else :
+            eroutes, iroutes = self.routes()
+            routes = eroutes + iroutes
+        return [r.replace("UPDATE", action) for r in routes]
+
+    def withdraw(self) :
+        writer.write(route_table.flow_commands(self, "withdraw"))
+        return
+
+    
+
+
+class PrefixTrieNode :
+
+    __slots__ = ("network", "length", "value", "children")
+
+    def __init__(self, network, length, value) :
+        self.network = network
+        self.length = length
+        self.value = value # None means a glue node
+        self.children = [None, None]
+        return
+
+
+class PrefixTrie :
+    """ Patricia trie of IP prefixes for one address family.
+    Prefixes are (network, length) pairs where network is an integer.
+    """
+
+    def __init__(self, width) :
+        """
+        @width: address length in bits, 32 or 128
+        """
+        self.width = width
+        self.root = None
+        self.count = 0
+        return
+
+    def __len__(self) :
+        return self.count
+
+    def _bit(self, network, pos) :
+        return (network >> (self.width - 1 - pos)) & 1
+
+    def _contains(self, outer, length, network) :
+        """ is network within the prefix (outer, length) ? """
+        shift = self.width - length
+        return (network >> shift) == (outer >> shift)
+
+    def _common_length(self, net_a, len_a, net_b, len_b) :
+        m = min(len_a, len_b)
+        x = (net_a ^ net_b) >> (self.width - m)
+        return m - x.bit_length()
+
+    def _mask(self, network, length) :
+        shift = self.width - length
+        return (network >> shift) << shift
+
+    def insert(self, network, length, value) :
+
+        new = PrefixTrieNode(network, length, value)
+
+        if not self.root :
+            self.root = new
+            self.count += 1
+            return
+
+        parent = None
+        node = self.root
+
+        while True :
+            clen = self._common_length(network, length,
+                                       node.network, node.length)
+
+            if clen < node.length :
+                # the new prefix diverges from, or covers, this node
+                if clen == length :
+                    branch = new
+                    self.count += 1
+                else :
+                    branch = PrefixTrieNode(self._mask(network, clen),
+                                            clen, None)
+                    branch.children[self._bit(network, clen)] = new
+                    self.count += 1
+                branch.children[self._bit(node.network, clen)] = node
+                self._replace_child(parent, node, branch)
+                return
+
+            if length == node.length :
+                if node.value is None :
+                    self.count += 1
+                node.value = value
+                return
+
+            b = self._bit(network, node.length)
+            if not node.children[b] :
+                node.children[b] = new
+                self.count += 1
+                return
+
+            parent = node
+            node = node.children[b]
+
+    def _replace_child(self, parent, old, new) :
+
+        if not parent :
+            self.root = new
+        elif parent.children[0] is old :
+            parent.children[0] = new
+        else :
+            parent.children[1] = new
+        return
+
+    def _path(self, network, length) :
+        """ nodes from the root toward (network, length), which cover it """
+
+        # _contains() and _bit() are inlined as this is the hot path.
+        path = []
+        width = self.width
+        node = self.root
+        while node and node.length <= length :
+            shift = width - node.length
+            if (network >> shift) != (node.network >> shift) :
+                break
+            path.append(node)
+            if node.length == length :
+                break
+            node = node.children[(network >> (shift - 1)) & 1]
+        return path
+
+    def exact(self, network, length) :
+
+        path = self._path(network, length)
+        if path and path[-1].length == length :
+            return path[-1].value
+        return None
+
+    def covering(self, network, length) :
+        """ values of all prefixes covering (network, length) """
+
+        return [node.value for node in self._path(network, length)
+                if node.value is not None]
+
+    def covered(self, network, length, limit = None) :
+        """ values of all prefixes within (network, length), or of the
+        first limit prefixes if limit is given.
+        """
+
+        node = self.root
+        while node and node.length < length :
+            node = node.children[self._bit(network, node.length)]
+
+        if not node or not self._contains(network, length, node.network) :
+            return []
+
+        values = []
+        stack = [node]
+        while stack :
+            node = stack.pop()
+            if node.value is not None :
+                if limit is not None and len(values) == limit :
+                    break
+                values.append(node.value)
+            for child in reversed(node.children) :
+                if child :
+                    stack.append(child)
+        return values
+
+    def remove(self, network, length) :
+
+        path = self._path(network, length)
+        if not path or path[-1].length != length or path[-1].value is None :
+            return None
+
+        node = path[-1]
+        value = node.value
+        node.value = None
+        self.count -= 1
+
+        # collapse glue nodes having less than two children
+        while path :
+            node = path.pop()
+            if node.value is not None :
+                break
+            parent = path[-1] if path else None
+            children = [c for c in node.children if c]
+            if len(children) == 2 :
+                break
+            self._replace_child(parent, node,
+                                children[0] if children else None)
+
+        return value
+
+    def clear(self) :
+        self.root = None
+        self.count = 0
+        return
+
+
+class SeqIndex :
+    """ set of flows ordered by Flow.seq, for cursor-based iteration.
+    seqs only grows at the tail because seq increases monotonically.
+    removed seqs are left in seqs and cleaned up later.
+    """
+
+    def __init__(self, flows = []) :
+        """
+        @flows: initial flows sorted by seq
+        """
+        self.seqs = [f.seq for f in flows]
+        self.flows = dict([(f.seq, f) for f in flows])
+        return
+
+    def __len__(self) :
+        return len(self.flows)
+
+    def __contains__(self, flow) :
+        return flow.seq in self.flows
+
+    def add(self, flow) :
+        self.seqs.append(flow.seq)
+        self.flows[flow.seq] = flow
+        return
+
+    def remove(self, flow) :
+        del(self.flows[flow.seq])
+        if len(self.seqs) > len(self.flows) * 2 + 64 :
+            self.seqs = [seq for seq in self.seqs if seq in self.flows]
+        return
+
+    def after(self, cursor) :
+        """ iterate flows having seq larger than cursor """
+
+        seqs = self.seqs
+        for x in range(bisect.bisect_right(seqs, cursor), len(seqs)) :
+            flow = self.flows.get(seqs[x])
+            if flow :
+                yield flow
+
+
+class RoutingInformationBase :
+    """ Methods changing the RIB (add_flow, override_flow, delete_flow,
+    destroy_all_flows and bulk) hold self.lock for writing, and write
+    exabgp commands while holding it, so that commands reach exabgp in
+    the order of the changes. Others, including iteration and find_*,
+    do not lock; callers must hold self.lock for reading.
+    """
+
+    def __init__(self, fps) :
+
+        self.fps = fps
+        self.flows = {} # key: flow.prefix (class Prefix), value: class Flow
+        self.tries = {
+            4 : PrefixTrie(32), # both prefix and prefix_natted of flows
+            6 : PrefixTrie(128),
+        }
+        self.journal = None # class Journal recording operations
+        self.lock = RWLock()
+        self.encode_workers = 1 # processes of FunctionPools.compile_chains
+
+        # generation is incremented on every change of the RIB, and
+        # identifies the contents for ETag with the instance id.
+        self.generation = 0
+        self.instance = "%x" % int(time.time() * 1000000)
+        self.bodies = {} # key: view, value: (version, body)
+
+        # secondary indexes for queries. key: name of index,
+        # value: dict of key: user vrf, function, fp name or cgn-ness,
+        # and value: SeqIndex of flows.
+        self.seq = 0
+        self.all = SeqIndex()
+        self.indexes = {
+            "vrf" : {},
+            "function" : {},
+            "fp" : {},
+            "cgn" : {},
+            "neighbor" : {},
+        }
+        self.chains = {} # key: chain string, value: number of flows
+        return
+
+    def __iter__(self) :
+        return iter(self.flows.values())
+
+    def len(self) :
+        return len(self.flows)
+
+    def flow_prefixes(self, flow) :
+
+        prefixes = [flow.prefix]
+        if flow.prefix_natted :
+            prefixes.append(flow.prefix_natted)
+        return prefixes
+
+    def find_flow(self, f) :
+
+        flow = self.flows.get(f.prefix)
+        if flow and flow == f :
+            return flow
+        return None
+
+    def find_flow_by_prefix(self, prefix) :
+        """ exact match on prefix or prefix_natted (class Prefix) """
+
+        trie = self.tries[prefix.version]
+        return trie.exact(prefix.network, prefix.length)
+
+    def route_owner(self, route) :
+        """ returns the flow having the route ("UPDATE" form), or None.
+        a route of a flow matches the prefix or prefix_natted of it.
+        """
+
+        text = route_prefix(route)
+        if not text :
+            return None
+        try :
+            prefix = Prefix.parse(text)
+        except ValueError :
+            return None
+
+        flow = self.find_flow_by_prefix(prefix)
+        if flow :
+            eroutes, iroutes = flow.routes()
+            if route in eroutes or route in iroutes :
+                return flow
+        return None
+
+    def find_overlapping_flows(self, prefix, limit = None) :
+        """ flows whose prefix or prefix_natted covers, or is covered by,
+        the prefix. at most limit flows if limit is given, so that the
+        walk does not visit all flows within a large prefix.
+        """
+
+        trie = self.tries[prefix.version]
+        flows = {} # key: seq, as a flow is in the trie for prefix_natted
+        for flow in (trie.covering(prefix.network, prefix.length) +
+                     trie.covered(prefix.network, prefix.length,
+                                  None if limit is None else limit * 2)) :
+            flows.setdefault(flow.seq, flow)
+        return list(flows.values())[:limit]
+
+    def add_flow(self, flow) :
+
+        log.info("Add Flow: %s" % flow)
+
+        fps = self.fps
+        if not flow.validate(fps) :
+            log.warn("Validation Failed: %s" % flow)
+            return False
+
+        with self.lock.write() :
+            if self.fps is not fps and not flow.validate(self.fps) :
+                return False # config reloaded since validation
+
+            cmds = []
+            if not self.install_flow(flow, cmds) :
+                return False
+
+            flow.written = writer.write(cmds)
+            self.record([flow.entry("add")])
+
+        return True
+
+    def install_flow(self, flow, cmds) :
+        """ encode and insert a validated flow into the RIB.
+        exabgp commands to announce the flow are appended to cmds.
+        """
+
+        prefixes = self.flow_prefixes(flow)
+
+        for prefix in prefixes :
+            if self.find_flow_by_prefix(prefix) :
+                log.error("Flow for Prefix '%s(%s)' already exists" %
+                          (flow.prefix, flow.prefix_natted))
+                return False
+
+        for prefix in prefixes :
+            flows = self.find_overlapping_flows(prefix, limit = 4)
+            if flows :
+                log.warn("Prefix '%s' of flow %s overlaps flows: %s%s" %
+                         (prefix, flow,
+                          ", ".join([str(f) for f in flows[:3]]),
+                          ", ..." if len(flows) > 3 else ""))
+
+        ret = flow.encode(self.fps)
+        if not ret :
+            return False
+
+        self.insert_flow(flow)
+        cmds.extend(route_table.flow_commands(flow, "announce"))
 
         return True
 
+    def insert_flow(self, flow) :
+
+        self.generation += 1
+        self.flows[flow.prefix] = flow
+        for prefix in self.flow_prefixes(flow) :
+            trie = self.tries[prefix.version]
+            trie.insert(prefix.network, prefix.length, flow)
+
+        self.seq += 1
+        flow.seq = self.seq
+        self.all.add(flow)
+        chain = "_".join(flow.chain)
+        self.chains[chain] = self.chains.get(chain, 0) + 1
+        template = flow.template
+        if template.index_keys is None :
+            template.index_keys = self.flow_index_keys(flow, template,
+                                                         self.fps)
+        for name, key in template.index_keys :
+            if not key in self.indexes[name] :
+                self.indexes[name][key] = SeqIndex()
+            self.indexes[name][key].add(flow)
+        return
+
+    def remove_flow(self, flow) :
+
+        self.generation += 1
+        del(self.flows[flow.prefix])
+        for prefix in self.flow_prefixes(flow) :
+            self.tries[prefix.version].remove(prefix.network, prefix.length)
+
+        self.all.remove(flow)
+        chain = "_".join(flow.chain)
+        self.chains[chain] -= 1
+        if not self.chains[chain] :
+            del(self.chains[chain])
+        for name, key in flow.template.index_keys :
+            index = self.indexes[name][key]
+            index.remove(flow)
+            if not index :
+                del(self.indexes[name][key])
+        return
+
+    def flow_index_keys(self, flow, template, fps) :
+        """ (name of index, key) of secondary indexes for a flow encoded
+        with the template of fps
+        """
+
+        keys = [("vrf", flow.start)]
+        fpnames = [fps.find_fp_by_name(flow.start).name]
+        cgn = False
+
+        for fnname in flow.chain :
+            fn = fps.find_function_by_name(fnname)
+            keys.append(("function", fnname))
+            if not fn.fp.name in fpnames :
+                fpnames.append(fn.fp.name)
+            cgn = cgn or fn.cgn
+
+        keys += [("fp", fpname) for fpname in fpnames]
+        keys.append(("cgn", cgn))
+        keys += [("neighbor", neighbor) for neighbor in template.neighbors]
+        return keys
+
+    def query(self, cursor = 0, limit = None, prefix = None,
+              covering = None, vrf = None, function = None, fp = None,
+              cgn = None, neighbor = None) :
+        """ returns (flows, next cursor) in order of insertion.
+        @cursor: returns flows inserted after the flow of the cursor
+        @limit: max number of flows
+        @prefix: flows whose prefix or prefix_natted is within prefix
+        @covering: flows whose prefix or prefix_natted covers covering
+        (prefix and covering are class Prefix)
+        @vrf, @function, @fp: flows of the user vrf, through the
+        function, or through the function pool
+        @cgn: flows with (True) or without (False) CGN function
+        @neighbor: flows having routes to the neighbor
+        next cursor is None if no more flows.
+        """
+
+        indexes = []
+
+        for name, key in (("vrf", vrf), ("function", function),
+                          ("fp", fp), ("cgn", cgn),
+                          ("neighbor", neighbor)) :
+            if key is not None :
+                indexes.append(self.indexes[name].get(key, SeqIndex()))
+
+        for p, covered in ((prefix, True), (covering, False)) :
+            if p is None :
+                continue
+            trie = self.tries[p.version]
+            if covered :
+                flows = trie.covered(p.network, p.length)
+            else :
+                flows = trie.covering(p.network, p.length)
+            flows = dict([(f.seq, f) for f in flows])
+            indexes.append(SeqIndex([flows[seq] for seq in sorted(flows)]))
+
+        if not indexes :
+            indexes = [self.all]
+
+        indexes.sort(key = len)
+        others = indexes[1:]
+
+        flows = []
+        for flow in indexes[0].after(cursor) :
+            if others and not all([flow in index for index in others]) :
+                continue
+            if limit is not None and len(flows) == limit :
+                return flows, cursor
+            flows.append(flow)
+            cursor = flow.seq # the last flow visited in the page
+
+        return flows, None
+
+    def export(self, size = 1000, **kwargs) :
+        """ generate all flows, or flows matching kwargs of query(), in
+        order of insertion. the lock is held only while each page of
+        @size flows is taken, so that a large RIB is exported without
+        blocking updates.
+        """
+
+        cursor = 0
+        while cursor is not None :
+            with self.lock.read() :
+                flows, cursor = self.query(cursor = cursor, limit = size,
+                                           **kwargs)
+            for flow in flows :
+                yield flow
+
+        return
+
+    def delete_flow(self, flow) :
+
+        log.info("Delete Flow : %s" % flow)
+
+        with self.lock.write() :
+            if self.flows.get(flow.prefix) is not flow :
+                return # already deleted
+            flow.withdraw()
+            self.remove_flow(flow)
+            self.record([{ "op" : "delete",
+                           "prefix" : str(flow.prefix) }])
+        return
+
+    def delete_flow_by_prefix(self, prefix) :
+        """ returns the deleted flow, or None if no flow for prefix """
+
+        with self.lock.write() :
+            flow = self.find_flow_by_prefix(prefix)
+            if not flow :
+                return None
+
+            log.info("Delete Flow : %s" % flow)
+            flow.withdraw()
+            self.remove_flow(flow)
+            self.record([{ "op" : "delete",
+                           "prefix" : str(flow.prefix) }])
+
+        return flow
+        
+    def destroy_all_flows(self) :
+
+        log.info("Destroy All Flows")
+
+        with self.lock.write() :
+            cmds = []
+            for flow in reversed(self.flows.values()) :
+                cmds.extend(route_table.flow_commands(flow, "withdraw"))
+            writer.write(cmds)
+
+            self.clear()
+            self.record([{ "op" : "destroy" }])
+
+    def clear(self) :
+        """ remove all flows from the RIB without withdrawing them """
+
+        self.generation += 1
+        self.flows.clear()
+        for trie in self.tries.values() :
+            trie.clear()
+        self.all = SeqIndex()
+        for index in self.indexes.values() :
+            index.clear()
+        self.chains.clear()
+        return
+
+    def reload(self, fps) :
+        """ replace FunctionPools with fps. flows whose routes or index
+        keys change are re-encoded, and the delta of their routes and of
+        the TOS flows is announced and withdrawn. returns a summary, or
+        None if an installed flow is invalid with fps, and then the RIB
+        is not changed.
+        """
+
+        with self.lock.write() :
+
+            reencode = self.compile_reload(fps)
+            if reencode is None :
+                return None
+
+            oldfps = self.fps
+            self.fps = fps
+
+            tos_announced, tos_withdrawn = fps.take_over_tos_flows(oldfps)
+
+            announced = list(tos_announced)
+            withdrawn = []
+            reencoded = []
+
+            for flow in list(self) :
+                if not reencode[flow.template] :
+                    flow.encode(fps) # the same routes from the new template
+                    continue
+
+                eroutes, iroutes = flow.routes()
+                oldroutes = eroutes + iroutes
+                self.remove_flow(flow)
+                flow.encode(fps)
+                self.insert_flow(flow)
+                eroutes, iroutes = flow.routes()
+                delta = route_delta(oldroutes, eroutes + iroutes)
+                announced.extend(route_table.unshared(delta[0]))
+                withdrawn.extend(route_table.unshared(delta[1]))
+                reencoded.append(flow)
+
+            withdrawn.extend(tos_withdrawn)
+            announced, withdrawn = route_table.settle(announced, withdrawn)
+            self.generation += 1
+
+            position = writer.write(
+                [r.replace("UPDATE", "announce") for r in announced] +
+                [r.replace("UPDATE", "withdraw") for r in withdrawn])
+            for flow in reencoded :
+                flow.written = position
+
+            summary = {
+                "diff" : oldfps.diff(fps),
+                "flows" : len(self.flows),
+                "reencoded_flows" : len(reencoded),
+                "announced_routes" : len(announced),
+                "withdrawn_routes" : len(withdrawn),
+            }
+
+        log.info(("Reloaded: %d flows re-encoded, %d routes announced, " +
+                  "%d routes withdrawn") % (len(reencoded), len(announced),
+                                            len(withdrawn)))
+        return summary
+
+    def compile_reload(self, fps) :
+        """ compile the templates of installed flows with fps. returns
+        dict of key: installed template, value: True if flows of the
+        template must be re-encoded, or None if an installed flow is
+        invalid with fps. callers must hold self.lock.
+        """
+
+        # a flow of each template represents flows of the template
+        templates = {}
+        for flow in self :
+            if not flow.template in templates :
+                templates[flow.template] = flow
+
+        fps.compile_chains([chain_key(flow) for flow in templates.values()],
+                           self.encode_workers)
+
+        for flow in templates.values() :
+            if (not flow.validate(fps) or
+                not fps.compile_chain(flow.start, flow.chain,
+                                      flow.prefix_natted is not None)) :
+                log.error("Cannot reload, flow %s is invalid: %s" %
+                          (flow, log.errmsg))
+                return None
+
+        reencode = {}
+        for template, flow in templates.items() :
+            new = fps.compile_chain(flow.start, flow.chain,
+                                    flow.prefix_natted is not None)
+            if new.index_keys is None :
+                new.index_keys = self.flow_index_keys(flow, new, fps)
+            reencode[template] = (new.eroutes != template.eroutes or
+                                  new.iroutes != template.iroutes or
+                                  new.index_keys != template.index_keys)
+
+        return reencode
+
+    def plan(self, ops, cmds) :
+        """ dry run of bulk(ops). exabgp commands that bulk(ops) would
+        write now are appended to cmds, and neither the RIB nor exabgp
+        is changed. Returns a list of (success, message) for each
+        operation, as bulk() does.
+        """
+
+        self.fps.compile_chains([chain_key(flow) for op, flow, prefix
+                                 in ops if flow], self.encode_workers)
+
+        with self.lock.read() :
+            return self.dry_run(ops, cmds)
+
+    def dry_run(self, ops, cmds) :
+        """ plan() without the lock. callers must hold self.lock. """
+
+        fps = self.fps
+        counts = route_table.counts # read only, flows do not change it
+
+        # flows of prefixes changed by former operations. key: Prefix,
+        # value: flow, or None if the flow is deleted.
+        staged = {}
+
+        def find(prefix) :
+            if prefix in staged :
+                return staged[prefix]
+            return self.find_flow_by_prefix(prefix)
+
+        def stage(flow, value) :
+            for prefix in self.flow_prefixes(flow) :
+                staged[prefix] = value
+
+        results = []
+
+        for op, flow, prefix in ops :
+            log.errmsg = None
+
+            if op == "delete" :
+                old = find(prefix)
+                if not old :
+                    msg = "No matched flow for %s" % prefix
+                    results.append((False, msg))
+                    continue
+                stage(old, None)
+                cmds.extend(route_table.flow_commands(old, "withdraw",
+                                                      counts))
+                results.append((True, "Flow: %s is deleted" % old))
+                continue
+
+            if not op in ("add", "override") :
+                msg = "Invalid operation '%s'" % op
+                results.append((False, msg))
+                continue
+
+            if not flow.validate(fps) :
+                results.append((False, log.errmsg))
+                continue
+
+            old = None
+            if op == "override" :
+                old = find(flow.prefix)
+                if not old and flow.prefix_natted :
+                    old = find(flow.prefix_natted)
+
+            exists = [p for p in self.flow_prefixes(flow)
+                      if find(p) and find(p) is not old]
+            if exists :
+                msg = ("Flow for Prefix '%s(%s)' already exists" %
+                       (flow.prefix, flow.prefix_natted))
+                results.append((False, msg))
+                continue
+
+            if not flow.encode(fps) :
+                results.append((False, log.errmsg))
+                continue
+
+            if not old :
+                cmds.extend(route_table.flow_commands(flow, "announce",
+                                                      counts))
+                results.append((True, "Flow : %s is added" % flow
+                                if op == "add" else
+                                "Flow : %s is overridden" % flow))
+                stage(flow, flow)
+                continue
+
+            eroutes, iroutes = old.routes()
+            oldroutes = eroutes + iroutes
+            eroutes, iroutes = flow.routes()
+            announced, withdrawn = route_delta(oldroutes, eroutes + iroutes)
+            announced = route_table.unshared(announced, counts)
+            withdrawn = route_table.unshared(withdrawn, counts)
+            cmds.extend([r.replace("UPDATE", "announce") for r in announced])
+            cmds.extend([r.replace("UPDATE", "withdraw") for r in withdrawn])
+            results.append((True, "Flow : %s is overridden" % flow))
+            stage(old, None)
+            stage(flow, flow)
+
+        return results
+
+    def plan_reload(self, fps, cmds) :
+        """ dry run of reload(fps). exabgp commands that reload(fps)
+        would write now are appended to cmds, and the RIB is not
+        changed. returns the summary of reload(), or None.
+        """
+
+        with self.lock.read() :
+
+            reencode = self.compile_reload(fps)
+            if reencode is None :
+                return None
+
+            counts = dict(route_table.counts)
+            tos_announced, tos_withdrawn = fps.take_over_tos_flows(self.fps,
+                                                                   counts)
+
+            announced = list(tos_announced)
+            withdrawn = []
+            reencoded = 0
+
+            for flow in self :
+                if not reencode[flow.template] :
+                    continue
+
+                eroutes, iroutes = flow.routes()
+                oldroutes = eroutes + iroutes
+                template = fps.compile_chain(flow.start, flow.chain,
+                                             flow.prefix_natted is not None)
+                eroutes, iroutes = template.render(*flow.prefix_strings())
+                delta = route_delta(oldroutes, eroutes + iroutes)
+                announced.extend(route_table.unshared(delta[0], counts))
+                withdrawn.extend(route_table.unshared(delta[1], counts))
+                reencoded += 1
+
+            withdrawn.extend(tos_withdrawn)
+            announced, withdrawn = route_table.settle(announced, withdrawn)
+            cmds.extend([r.replace("UPDATE", "announce") for r in announced])
+            cmds.extend([r.replace("UPDATE", "withdraw") for r in withdrawn])
+
+            return {
+                "diff" : self.fps.diff(fps),
+                "flows" : len(self.flows),
+                "reencoded_flows" : reencoded,
+                "announced_routes" : len(announced),
+                "withdrawn_routes" : len(withdrawn),
+            }
+
+    def neighbor_tos_commands(self, address, action = "announce") :
+        """ exabgp commands of TOS flows announced to a neighbor """
+
+        eroutes, iroutes = self.fps.announced_tos_flow_routes(action)
+        return [r for r in eroutes + iroutes if route_neighbor(r) == address]
+
+    def replay_neighbor(self, address) :
+        """ announce the TOS flows and the routes of flows to a neighbor
+        again. returns (number of the last command written, number of
+        routes).
+        """
+
+        with self.lock.read() :
+            cmds = self.neighbor_tos_commands(address)
+            flows = self.indexes["neighbor"].get(address, SeqIndex())
+            for flow in flows.after(0) :
+                cmds.extend(flow.commands("announce", neighbor = address))
+            position = writer.write(cmds)
+
+        log.info("Replayed %d routes of %d flows to neighbor %s" %
+                 (len(cmds), len(flows), address))
+        return position, len(cmds)
+
+    def record(self, entries) :
+        """ record entries of applied operations to the journal """
+
+        if not self.journal or not entries :
+            return
+
+        self.journal.append(entries)
+        if self.journal.need_compaction() :
+            self.journal.compact(self)
+        return
+
+    def version(self, view) :
+        """ version of the rendering of a view. the json view includes
+        the status of routes, which changes with messages from exabgp.
+        """
+        if view == "json" and reader.running :
+            return "%d.%d" % (self.generation, reader.version)
+        return "%d" % self.generation
+
+    def etag(self, view) :
+        return "%s-%s-%s" % (self.instance, self.version(view), view)
+
+    def render(self, view) :
+        """ returns the body of a view of /show/flow. the body is built
+        from cached renderings of flows, and cached until the RIB
+        changes.
+        """
+
+        version = self.version(view)
+        cached = self.bodies.get(view)
+        if cached and cached[0] == version :
+            return cached[1]
+
+        if view == "html" :
+            outputs = ["<pre>" + flow.render("extensive") + "</pre>"
+                       for flow in self]
+            if not outputs :
+                outputs = ["no flow installed."]
+            body = "\n".join(["<html>"] + outputs + ["</html>"])
+        elif view == "json" :
+            body = "[%s]\n" % ",".join([flow.render(view) for flow in self])
+        else :
+            body = "\n".join([flow.render(view) for flow in self])
+
+        self.bodies[view] = (version, body)
+        return body
+
+    def find_overridden_flow(self, flow) :
+        """ installed flow having the prefix or prefix_natted of flow """
+
+        old = self.find_flow_by_prefix(flow.prefix)
+        if not old and flow.prefix_natted :
+            old = self.find_flow_by_prefix(flow.prefix_natted)
+        return old
+
+    def override_flow(self, flow) :
+        """ replace the flow having the same prefix with the flow.
+        only the differences of routes are announced and withdrawn.
+        """
+
+        log.info("Override Flow: %s" % flow)
+
+        fps = self.fps
+        if not flow.validate(fps) :
+            log.warn("Validation Failed: %s" % flow)
+            return False
+
+        with self.lock.write() :
+            if self.fps is not fps and not flow.validate(self.fps) :
+                return False # config reloaded since validation
+
+            cmds = []
+            if not self.stage_override(flow, cmds) :
+                return False
+
+            flow.written = writer.write(cmds)
+            self.record([flow.entry("override")])
+
+        return True
+
+    def stage_override(self, flow, cmds) :
+        """ override with a validated flow. exabgp commands for the
+        route delta are appended to cmds: announcements of new routes
+        first, and then withdrawals of stale routes.
+        """
+
+        old = self.find_overridden_flow(flow)
+        if not old :
+            return self.install_flow(flow, cmds)
+
+        self.remove_flow(old)
+
+        announces = []
+        if not self.install_flow(flow, announces) :
+            self.insert_flow(old)
+            return False
+
+        eroutes, iroutes = old.routes()
+        oldroutes = eroutes + iroutes
+        eroutes, iroutes = flow.routes()
+        newroutes = eroutes + iroutes
+        announced, withdrawn = route_delta(oldroutes, newroutes)
+        announced = route_table.unshared(announced)
+        withdrawn = route_table.unshared(withdrawn)
+
+        log.info("Override %s with %s: %d announced, %d withdrawn" %
+                 (old, flow, len(announced), len(withdrawn)))
+
+        cmds.extend([r.replace("UPDATE", "announce") for r in announced])
+        cmds.extend([r.replace("UPDATE", "withdraw") for r in withdrawn])
+
+        return True
+
+    def bulk(self, ops, emit = True, atomic = False) :
+        """
+        @ops: list of (op, flow, prefix). op is "add", "override" or
+        "delete". flow is None for delete, and prefix is used instead.
+        @emit: if False, the RIB is updated without exabgp commands.
+        @atomic: if True, all operations are applied, or none of them.
+
+        All flows are validated first, then the operations are applied
+        in order and all exabgp commands are written at once.
+        Returns a list of (success, message) for each operation.
+        With atomic, if an operation fails, nothing is changed and
+        written, and the other operations fail with TRANSACTION_ABORTED.
+        """
+
+        results = []
+        valid = []
+
+        fps = self.fps
+        for op, flow, prefix in ops :
+            log.errmsg = None
+            if flow and not flow.validate(fps) :
+                results.append((False, log.errmsg))
+                valid.append(False)
+            else :
+                results.append(None)
+                valid.append(True)
+
+        if atomic and not all(valid) :
+            return abort_results(results)
+
+        fps.compile_chains([chain_key(flow) for (op, flow, prefix), ok
+                            in zip(ops, valid) if flow and ok],
+                           self.encode_workers)
+
+        with self.lock.write() :
+
+            # the dry run on the locked RIB tells whether all operations
+            # succeed before anything is changed.
+            if atomic :
+                planned = self.dry_run(ops, [])
+                if not all([success for success, msg in planned]) :
+                    return abort_results(planned)
+
+            cmds = []
+            entries = []
+            installed = []
+
+            for x, (op, flow, prefix) in enumerate(ops) :
+                if not valid[x] :
+                    continue
+
+                log.errmsg = None
+
+                if (flow and self.fps is not fps and
+                    not flow.validate(self.fps)) :
+                    # config reloaded since validation
+                    results[x] = (False, log.errmsg)
+                    continue
+
+                if op == "add" :
+                    if self.install_flow(flow, cmds) :
+                        installed.append(flow)
+                        entries.append(flow.entry("add"))
+                        msg = "Flow : %s is added" % flow
+                        results[x] = (True, msg)
+                    else :
+                        results[x] = (False, log.errmsg)
+
+                elif op == "override" :
+                    if self.stage_override(flow, cmds) :
+                        installed.append(flow)
+                        entries.append(flow.entry("override"))
+                        msg = "Flow : %s is overridden" % flow
+                        results[x] = (True, msg)
+                    else :
+                        results[x] = (False, log.errmsg)
+
+                elif op == "delete" :
+                    old = self.find_flow_by_prefix(prefix)
+                    if not old :
+                        msg = "No matched flow for %s" % prefix
+                        results[x] = (False, msg)
+                    else :
+                        log.info("Delete Flow : %s" % old)
+                        self.remove_flow(old)
+                        cmds.extend(route_table.flow_commands(old,
+                                                              "withdraw"))
+                        entries.append({ "op" : "delete",
+                                         "prefix" : str(prefix) })
+                        results[x] = (True, "Flow: %s is deleted" % old)
+
+                else :
+                    results[x] = (False, "Invalid operation '%s'" % op)
+
+            if emit :
+                position = writer.write(cmds)
+                for flow in installed :
+                    flow.written = position
+            self.record(entries)
+
+        return results
+
+
+class Journal :
+    """ append-only journal of RIB operations.
+
+    Each line of the journal is a bulk entry (see parse_bulk_entry) of
+    an applied operation, or {"op": "destroy"}. The first line is a
+    header {"epoch": N}. Every compact_every records, the whole RIB is
+    written to a snapshot of epoch N + 1 and the journal is restarted
+    with epoch N + 1, so a journal older than the snapshot is ignored.
+    Flows which fail to replay, for example with a function removed from
+    config.json, are kept in snapshots until an operation on the prefix.
+    """
+
+    def __init__(self, path, compact_every = 10000) :
+
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.compact_every = compact_every
+        self.epoch = 0
+        self.records = 0 # number of records since the last snapshot
+        self.failed = {} # key: prefix, value: entry failed to replay
+        self.f = None
+        return
+
+    def read(self, path) :
+        """ returns (epoch, list of entries) of a journal or snapshot """
+
+        if not os.path.exists(path) :
+            return (-1, [])
+
+        epoch = -1
+        entries = []
+
+        with open(path, 'r') as f :
+            for lineno, line in enumerate(f) :
+                try :
+                    entry = json.loads(line)
+                except ValueError :
+                    # a torn write of the last line by a crash
+                    log.warn("Ignore broken line %d of %s" %
+                             (lineno + 1, path))
+                    continue
+                if lineno == 0 and "epoch" in entry :
+                    epoch = entry["epoch"]
+                    continue
+                entries.append(entry)
+
+        return (epoch, entries)
+
+    def load(self) :
+        """ returns entries to rebuild the RIB """
+
+        sepoch, sentries = self.read(self.snapshot_path)
+        jepoch, jentries = self.read(self.path)
+
+        self.epoch = max(sepoch, jepoch, 0)
+
+        if jepoch < sepoch :
+            log.info("Ignore journal epoch %d older than snapshot %d" %
+                     (jepoch, sepoch))
+            return sentries
+
+        return sentries + jentries
+
+    def replay(self, rib) :
+        """ rebuild the RIB from the snapshot and the journal, and then
+        announce all flows at once.
+        """
+
+        # replay allocates many long-lived objects and frees nothing,
+        # so cyclic garbage collection is only overhead here.
+        gc.disable()
+        try :
+            self.replay_entries(rib)
+        finally :
+            gc.enable()
+        return
+
+    def replay_entries(self, rib) :
+
+        start = time.time()
+        entries = self.load()
+
+        # flows before the last destroy do not survive
+        for x in range(len(entries) - 1, -1, -1) :
+            if entries[x].get("op") == "destroy" :
+                entries = entries[x + 1:]
+                break
+
+        ops = []
+        parsed = []
+        for entry in entries :
+            try :
+                ops.append(parse_bulk_entry(entry))
+                parsed.append(entry)
+            except ValueError as e :
+                log.error("Invalid journal entry: %s" % e)
+
+        results = rib.bulk(ops, emit = False)
+        for (op, flow, prefix), entry, (success, msg) in zip(ops, parsed,
+                                                             results) :
+            if success or op == "delete" :
+                self.failed.pop(str(prefix), None)
+            else :
+                log.error("Failed to replay %s %s: %s" % (op, prefix, msg))
+                self.failed[str(prefix)] = dict(entry, op = "add")
+
+        if self.failed :
+            log.warn("Keep %d flows failed to replay in the journal" %
+                     len(self.failed))
+
+        with rib.lock.read() :
+            cmds = []
+            for flow in rib :
+                cmds.extend(route_table.flow_commands(flow, "announce"))
+            position = writer.write(cmds)
+            for flow in rib :
+                flow.written = position
+
+        log.info("Replayed %d journal entries into %d flows in %.3f sec" %
+                 (len(entries), rib.len(), time.time() - start))
+        return
+
+    def open(self) :
+
+        self.f = open(self.path, 'a')
+        if self.f.tell() == 0 :
+            self.write_header(self.f)
+        return
+
+    def write_header(self, f) :
+
+        f.write("%s\n" % json.dumps({ "epoch" : self.epoch }))
+        f.flush()
+        os.fsync(f.fileno())
+        return
+
+    def append(self, entries) :
+
+        if not self.f :
+            self.open()
+
+        self.f.write("".join(["%s\n" % json.dumps(entry)
+                              for entry in entries]))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.records += len(entries)
+
+        if self.failed :
+            for entry in entries :
+                if entry.get("op") == "destroy" :
+                    self.failed.clear()
+                else :
+                    self.failed.pop(entry.get("prefix"), None)
+        return
+
+    def need_compaction(self) :
+        return self.records >= self.compact_every
+
+    def compact(self, rib) :
+        """ write the RIB to a new snapshot and restart the journal """
+
+        start = time.time()
+        epoch = self.epoch + 1
+        tmp = self.snapshot_path + ".tmp"
+
+        with open(tmp, 'w') as f :
+            f.write("%s\n" % json.dumps({ "epoch" : epoch }))
+            for entry in self.failed.values() :
+                f.write("%s\n" % json.dumps(entry))
+            for flow in rib :
+                f.write("%s\n" % json.dumps(flow.entry("add")))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+        if self.f :
+            self.f.close()
+        self.epoch = epoch
+        self.records = 0
+        self.f = open(self.path, 'w')
+        self.write_header(self.f)
+
+        log.info(("Compact journal to snapshot epoch %d, %d flows and %d " +
+                  "flows failed to replay, %.3f sec") %
+                 (epoch, rib.len(), len(self.failed), time.time() - start))
+        return
+
+
+class Operation :
+    """ an operation on the RIB submitted to ControlPlane. The state is
+    "queued", "running" or "done", and success and result are set when
+    it is done.
+    """
+
+    def __init__(self, id, kind, args) :
+
+        self.id = id
+        self.kind = kind # see do_* of ControlPlane
+        self.args = args
+        self.state = "queued"
+        self.success = None
+        self.result = None # message, or list or dict to be JSON
+        self.submitted = time.time()
+        self.finished = None
+        self.event = threading.Event()
+        return
+
+    def finish(self, success, result) :
+
+        self.success = success
+        self.result = result
+        self.finished = time.time()
+        self.state = "done"
+        self.event.set()
+        return
+
+    def wait(self, timeout = None) :
+        """ returns True if the operation is done """
+        return self.event.wait(timeout)
+
+    def json(self) :
+
+        out = {
+            "id" : self.id,
+            "op" : self.kind,
+            "state" : self.state,
+            "submitted" : self.submitted,
+            "finished" : self.finished,
+        }
+        if self.state == "done" :
+            out["success"] = self.success
+            out["result"] = self.result
+        return out
+
+
+class ControlPlane :
+    """ asyncio event loop on a thread, owning the changes of the RIB.
+
+    REST handlers only submit operations and get Operation objects,
+    and a single task of the loop applies the operations to the RIB in
+    the submitted order. The RIB lock and the backpressure of the
+    writer are waited on a worker thread, so that the loop (and the
+    ExaBGPReader on it) is never blocked. Before start(), operations
+    are applied on the submitting thread.
+    """
+
+    def __init__(self, keep = 10000) :
+        """
+        @keep: number of operations kept to be polled
+        """
+        self.keep = keep
+        self.loop = None
+        self.queue = None # asyncio.Queue of Operation
+        self.thread = None
+        self.executor = None
+        self.tasks = set() # the loop keeps only weak references to tasks
+        self.lock = threading.Lock()
+        self.operations = collections.OrderedDict() # key: id
+        self.last_id = 0
+        self.pending = 0 # operations queued or running
+        return
+
+    def start(self) :
+
+        if self.thread :
+            return
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = 1, thread_name_prefix = "control-plane-rib")
+        started = threading.Event()
+
+        def run() :
+            asyncio.set_event_loop(self.loop)
+            self.queue = asyncio.Queue()
+            self.loop.call_soon(started.set)
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target = run, name = "control-plane",
+                                       daemon = True)
+        self.thread.start()
+        started.wait()
+        self.spawn(self.run())
+        return
+
+    def spawn(self, coro) :
+        """ run a coroutine as a task on the loop, from any thread """
+
+        def create() :
+            task = self.loop.create_task(coro)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        self.loop.call_soon_threadsafe(create)
+        return
+
+    def submit(self, kind, *args) :
+        """ returns Operation of kind, which is applied with args """
+
+        with self.lock :
+            self.last_id += 1
+            op = Operation(self.last_id, kind, args)
+            self.operations[op.id] = op
+            self.pending += 1
+
+            # forget old operations, which are done in the order
+            while len(self.operations) > self.keep :
+                oldest = next(iter(self.operations.values()))
+                if oldest.state != "done" :
+                    break
+                self.operations.popitem(last = False)
+
+        if not self.thread :
+            self.apply(op)
+        else :
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, op)
+
+        return op
+
+    def find(self, id) :
+        with self.lock :
+            return self.operations.get(id)
+
+    async def run(self) :
+
+        while True :
+            op = await self.queue.get()
+            await self.loop.run_in_executor(self.executor, self.apply, op)
+
+    def apply(self, op) :
+
+        op.state = "running"
+        log.errmsg = None
+
+        try :
+            success, result = getattr(self, "do_" + op.kind)(*op.args)
+        except Exception as e :
+            logger.error("ERROR: operation %d (%s) failed: %s" %
+                         (op.id, op.kind, e))
+            success, result = False, "Operation failed: %s" % e
+
+        with self.lock :
+            self.pending -= 1
+        metrics.observe("flowchain_operation_seconds",
+                        time.time() - op.submitted, (("op", op.kind),))
+        op.finish(success, result)
+        return
+
+    def do_add(self, flow) :
+
+        if not rib.add_flow(flow) :
+            return False, log.errmsg
+        return True, "Flow : %s is added" % flow
+
+    def do_override(self, flow) :
+
+        if not rib.override_flow(flow) :
+            return False, log.errmsg
+        return True, "Flow : %s is overridden" % flow
+
+    def do_delete(self, prefix) :
+
+        flow = rib.delete_flow_by_prefix(prefix)
+        if not flow :
+            return False, "No matched flow for %s" % prefix
+        return True, "Flow: %s is deleted" % flow
+
+    def do_bulk(self, entries) :
+        """ returns a list of results of the bulk entries """
+        return True, bulk_results(entries, rib.bulk)
+
+    def do_transaction(self, entries) :
+        """ bulk entries applied atomically. succeeds only if all the
+        entries are committed.
+        """
+
+        results = bulk_results(entries,
+                               lambda ops : rib.bulk(ops, atomic = True),
+                               atomic = True)
+        committed = all([result["success"] for result in results])
+        return committed, { "committed" : committed, "results" : results }
+
+    def do_destroy(self) :
+
+        rib.destroy_all_flows()
+        return True, "Destroyed all flows"
+
+    def do_reload(self, configjson) :
+
+        summary = reload_config(configjson)
+        if not summary :
+            return False, log.errmsg
+        return True, summary
+
+    def stats(self) :
+
+        with self.lock :
+            return {
+                "running" : bool(self.thread),
+                "pending" : self.pending,
+                "operations" : len(self.operations),
+                "last_id" : self.last_id,
+            }
+
+control = ControlPlane()
+
+metrics.describe("flowchain_operation_seconds", "histogram",
+                 "seconds from submission to completion of operations")
+
+
+def load_config(configjson) :
+
+    log.info("Start to load config file %s" % configjson)
+
+    fps = []
+
+    with open(configjson, 'r') as f :
+        cfg = json.load(f)
+
+    for fpname, v in cfg.items() :
+        log.info("Load Function Pool %s" % fpname)
+
+        fp = FunctionPool(fpname,
+                          cfg[fpname]["community"], cfg[fpname]["neighbor"])
+
+        for f in v["function"] :
+            log.info("Add Function %s to %s" % (f["name"], fpname))
+
+            fn = Function(f["name"], f["rd-top"], f["rd-bot"],
+                          f["mark-top"], f["mark-bottom"],
+                          f["cgn"])
+            fp.add_function(fn)
+
+        for fpname, rd in v["inter-fp-rd"]["global"].items() :
+            fp.add_inter_fp_rd("global", fpname, rd)
+
+        for fpname, rd in v["inter-fp-rd"]["private"].items() :
+            fp.add_inter_fp_rd("private", fpname, rd)
+
+            
+        for vrfname, rd in v["user-vrf-rd"].items() :
+            fp.add_user_vrf_rd(vrfname, rd)
+        
+        fps.append(fp)
+
+    return fps
+
+
+def reload_config(configjson) :
+    """ load the config file again and reload it into the RIB.
+    returns the summary of RoutingInformationBase.reload(), or None.
+    """
+
+    log.info("Reload config file %s" % configjson)
+
+    try :
+        fps = FunctionPools(load_config(configjson))
+    except (OSError, ValueError, KeyError, TypeError, RuntimeError) as e :
+        log.error("Failed to load config file %s: %s" % (configjson, e))
+        return None
+
+    return rib.reload(fps)
+
+
+def reload_on_sighup(signum, frame) :
+    # submit on another thread, because the signal may interrupt a
+    # thread holding the lock of the control plane.
+    threading.Thread(target = control.submit, args = ("reload", config_path),
+                     daemon = True).start()
+
+
+def replay_neighbor(address) :
+    """ announce the routes of a neighbor again. called by ExaBGPReader
+    when a neighbor becomes up again, and by /neighbor/<address>/resync.
+    """
+
+    position, routes = rib.replay_neighbor(address)
+    writer.resynced(address, position)
+    reader.replayed(address, position)
+    return routes
+
+
+
+""" REST API """
+
+@app.before_request
+def reset_errmsg() :
+    # each request has its own error message, see logger_wrapper
+    log.errmsg = None
+
+
+@app.before_request
+def start_request_timer() :
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response) :
+    """ latency per route until the response is made. the body of a
+    streamed response is generated after this.
+    """
+
+    start = g.get("start")
+    if start is None :
+        return response
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = (("method", request.method), ("route", route))
+    metrics.observe("flowchain_http_request_seconds",
+                    time.perf_counter() - start, labels)
+    metrics.inc("flowchain_http_requests_total",
+                labels + (("status", str(response.status_code)),))
+    return response
+
+metrics.describe("flowchain_http_request_seconds", "histogram",
+                 "latency of REST API requests per route")
+metrics.describe("flowchain_http_requests_total", "counter",
+                 "REST API requests per route and status")
+
+
+def parse_url_prefixes(prefix, preflen, prefix_natted, preflen_natted) :
+    """ returns (Prefix, Prefix or None) from the path of /add and
+    /override. raises ValueError for invalid prefixes.
+    """
+
+    prefix = Prefix.parse(prefix + "/" + preflen)
+    if prefix_natted == "none" :
+        return prefix, None
+
+    return prefix, Prefix.parse(prefix_natted + "/" + preflen_natted)
+
+
+@app.route("/add/<prefix>/<preflen>/<prefix_natted>/<preflen_natted>/" +
+           "<start>/<chain_string>",
+           methods = ["GET", "POST"])
+def rest_add_flow(prefix, preflen, prefix_natted, preflen_natted,
+                  start, chain_string) :
+    """
+    @start : user vrf name
+    @prefix: user prefix
+    @prefix_natted: user prefix after NAT. if not, use 'none'.
+    @chain : <fpname>_<fpname>_<fpname>...
+    """
+    
+    response = make_response()
+
+    try :
+        prefix, prefix_natted = parse_url_prefixes(prefix, preflen,
+                                                   prefix_natted,
+                                                   preflen_natted)
+    except ValueError as e :
+        response.data = str(e)
+        response.status_code = 400
+        return response
+
+    flow = Flow(start, chain_string.split("_"), prefix, prefix_natted)
+    return operation_response(control.submit("add", flow))
+
+
+@app.route("/override/<prefix>/<preflen>/<prefix_natted>/<preflen_natted>/" +
+           "<start>/<chain_string>",
+           methods = ["GET", "POST"])
+def rest_override_flow(prefix, preflen, prefix_natted, preflen_natted,
+                       start, chain_string) :
+    """
+    @start : user vrf name
+    @prefix: user prefix
+    @prefix_natted: user prefix after NAT. if not, use 'none'.
+    @chain : <fpname>_<fpname>_<fpname>...
+    """
+    
+    response = make_response()
+
+    try :
+        prefix, prefix_natted = parse_url_prefixes(prefix, preflen,
+                                                   prefix_natted,
+                                                   preflen_natted)
+    except ValueError as e :
+        response.data = str(e)
+        response.status_code = 400
+        return response
+
+    flow = Flow(start, chain_string.split("_"), prefix, prefix_natted)
+    return operation_response(control.submit("override", flow))
+
+
+
+@app.route("/delete/<prefix>/<preflen>", methods = ["GET", "POST"])
+def rest_delete_flow(prefix, preflen) :
+    """
+    @prefix: user prefix for deleting flow
+    """
+
+    response = make_response()
+
+    try :
+        prefix = Prefix.parse(prefix + "/" + preflen)
+    except ValueError as e :
+        response.data = str(e)
+        response.status_code = 400
+        return response
+
+    return operation_response(control.submit("delete", prefix))
+    
+
+TRANSACTION_ABORTED = "Not applied, transaction aborted"
+
+
+def abort_results(results) :
+    """ results of an aborted transaction. successful results, and
+    operations not tried (None), are replaced with TRANSACTION_ABORTED.
+    """
+
+    return [result if result and not result[0]
+            else (False, TRANSACTION_ABORTED) for result in results]
+
+
+def chain_key(flow) :
+    """ key of the chain cache of FunctionPools for a flow """
+    return (flow.start, tuple(flow.chain), flow.prefix_natted is not None)
+
+
+def route_nlri(route) :
+    """ exabgp identifies a flow route by its NLRI (neighbor, rd and
+    match), and not by the actions after 'then'.
+    """
+    return route.partition(" then ")[0]
+
+
+def route_prefix(route) :
+    """ prefix of the match of a route, "match { source|destination
+    PREFIX; ...", or None.
+    """
+    start = route.find("match { ")
+    if start < 0 :
+        return None
+    words = route[start + 8:].split(";", 1)[0].split()
+    if len(words) != 2 or not words[0] in ("source", "destination") :
+        return None
+    return words[1]
+
+
+def command_nlri(cmd) :
+    """ NLRI of an exabgp command, the same as route_nlri() of the route
+    in the "UPDATE" form.
+    """
+    x = cmd.index(" ", 9) + 1 # the action after "neighbor ADDRESS "
+    return "%sUPDATE%s" % (cmd[:x], route_nlri(cmd[cmd.index(" ", x):]))
+
+
+def route_neighbor(route) :
+    """ neighbor address of a route or command, "neighbor ADDRESS ..." """
+    return route[9:route.index(" ", 9)]
+
+
+def route_delta(oldroutes, newroutes) :
+    """ returns (routes to be announced, routes to be withdrawn) to
+    move from oldroutes to newroutes. an old route is not withdrawn if
+    a new route having the same NLRI replaces it by the announcement.
+    """
+
+    oldset = set(oldroutes)
+    newset = set(newroutes)
+    newnlris = set([route_nlri(r) for r in newroutes])
+
+    announced = []
+    for r in newroutes :
+        if not r in oldset and not r in announced :
+            announced.append(r)
+
+    withdrawn = []
+    for r in oldroutes :
+        if (not r in newset and not route_nlri(r) in newnlris and
+            not r in withdrawn) :
+            withdrawn.append(r)
+
+    return announced, withdrawn
+
+
+def parse_bulk_entry(entry) :
+    """
+    @entry: dict of a bulk operation, for example,
+      {"op": "add", "prefix": "10.1.1.0/24",
+       "prefix_natted": "192.168.255.1/32", "start": "fp1-private",
+       "chain": "fp1-fn1_fp1-cgn"}
+    "op" is "add" (default), "override" or "delete". "prefix_natted" may
+    be omitted or null, and "chain" may be a list of function names.
+    Returns (op, flow, prefix), prefix is class Prefix. raises
+    ValueError for malformed entry.
+    """
+
+    if not isinstance(entry, dict) :
+        raise ValueError("Bulk entry must be an object: %s" % entry)
+
+    op = entry.get("op", "add")
+    prefix = entry.get("prefix")
+
+    if not op in ("add", "override", "delete") :
+        raise ValueError("Invalid operation '%s'" % op)
+    prefix = Prefix.parse(prefix)
+
+    if op == "delete" :
+        return (op, None, prefix)
+
+    start = entry.get("start")
+    chain = entry.get("chain")
+    prefix_natted = entry.get("prefix_natted")
+
+    if isinstance(chain, str) :
+        chain = chain.split("_")
+    if not isinstance(start, str) or not chain :
+        raise ValueError("Bulk entry requires 'start' and 'chain': %s" %
+                         entry)
+    if (not isinstance(chain, list) or
+        not all([isinstance(fn, str) for fn in chain])) :
+        raise ValueError("Invalid chain '%s'" % entry.get("chain"))
+    if not (prefix_natted is None or isinstance(prefix_natted, str)) :
+        raise ValueError("Invalid prefix_natted '%s'" % prefix_natted)
+    if prefix_natted in ("none", "") :
+        prefix_natted = None
+    if prefix_natted is not None :
+        prefix_natted = Prefix.parse(prefix_natted)
+
+    return (op, Flow(start, list(chain), prefix, prefix_natted), prefix)
+
+
+def parse_bulk_body(body) :
+    """ returns bulk entries of a JSON list, or NDJSON, one entry per
+    line. raises ValueError for malformed JSON.
+    """
+
+    if body.lstrip().startswith("[") :
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def bulk_results(entries, apply, atomic = False) :
+    """ results of bulk entries as a list of JSON objects. apply(ops)
+    returns (success, message) of each of ops parsed from entries, like
+    RoutingInformationBase.bulk(). with atomic, apply is not called if
+    an entry is malformed.
+    """
+
+    ops = []
+    opindex = [] # index of entries for ops
+    results = [None] * len(entries)
+
+    for x, entry in enumerate(entries) :
+        try :
+            ops.append(parse_bulk_entry(entry))
+            opindex.append(x)
+        except ValueError as e :
+            results[x] = (False, str(e))
+
+    if atomic and len(ops) < len(entries) :
+        applied = [(False, TRANSACTION_ABORTED)] * len(ops)
+    else :
+        applied = apply(ops)
+
+    for x, result in zip(opindex, applied) :
+        results[x] = result
+
+    outputs = []
+    for entry, (success, msg) in zip(entries, results) :
+        if not isinstance(entry, dict) :
+            entry = {}
+        outputs.append({
+            "prefix" : entry.get("prefix"),
+            "success" : success,
+            "message" : msg,
+        })
+
+    return outputs
+
+
+@app.route("/bulk", methods = ["POST"])
+def rest_bulk() :
+    """
+    body is a JSON list of bulk entries (see parse_bulk_entry), or
+    NDJSON, one entry per line. returns a JSON list of results.
+    """
+
+    try :
+        entries = parse_bulk_body(request.get_data(as_text = True))
+    except ValueError as e :
+        response = make_response()
+        response.data = "Invalid bulk request: %s" % e
+        response.status_code = 400
+        return response
+
+    return operation_response(control.submit("bulk", entries))
+
+
+@app.route("/transaction", methods = ["POST"])
+def rest_transaction() :
+    """ body is the same as /bulk. all the entries are applied and
+    their routes are written at once, or nothing is changed if an entry
+    fails. returns {"committed": bool, "results": [...]} in JSON, and
+    400 if not committed.
+    """
+
+    try :
+        entries = parse_bulk_body(request.get_data(as_text = True))
+    except ValueError as e :
+        response = make_response()
+        response.data = "Invalid transaction request: %s" % e
+        response.status_code = 400
+        return response
+
+    return operation_response(control.submit("transaction", entries))
+
+
+@app.route("/destroy", methods = ["GET", "POST"])
+def rest_destroy() :
+
+    return operation_response(control.submit("destroy"))
 
-    def announce(self) :
-        for r in self.eroutes :
-            sys.stdout.write("%s\n" % r.replace("UPDATE", "announce"))
-            sys.stdout.flush()
-        for r in self.iroutes :
-            sys.stdout.write("%s\n" % r.replace("UPDATE", "announce"))
-            sys.stdout.flush()
 
-        return
-        
+@app.route("/reload", methods = ["GET", "POST"])
+def rest_reload() :
+    """ reload the config file. the response is the summary of the
+    changes in JSON.
+    """
 
-    def withdraw(self) :
-        for r in self.eroutes :
-            sys.stdout.write("%s\n" % r.replace("UPDATE", "withdraw"))
-            sys.stdout.flush()
-        for r in self.iroutes :
-            sys.stdout.write("%s\n" % r.replace("UPDATE", "withdraw"))
-            sys.stdout.flush()
+    return operation_response(control.submit("reload", config_path))
 
-        return
 
-    
+def plan_summary(cmds) :
+    """ numbers of announce and withdraw commands in total and for
+    each neighbor.
+    """
 
+    summary = { "announce" : 0, "withdraw" : 0, "neighbors" : {} }
+    neighbors = summary["neighbors"]
 
-class RoutingInformationBase :
+    for cmd in cmds :
+        address, action = cmd.split(" ", 3)[1:3]
+        if not address in neighbors :
+            neighbors[address] = { "announce" : 0, "withdraw" : 0 }
+        neighbors[address][action] += 1
+        summary[action] += 1
 
-    def __init__(self, fps) :
+    return summary
 
-        self.fps = fps
-        self.flows = []
-        return
 
-    def __iter__(self) :
-        return self.flows.__iter__()
+def plan_response(results, cmds, summary = None) :
+    """ response of /plan. commands=false omits the commands. """
 
-    def len(self) :
-        return len(self.flows)
+    out = dict(summary) if summary else {}
+    out.update(plan_summary(cmds))
+    if results is not None :
+        out["results"] = results
+    if request.args.get("commands", "").lower() not in ("false", "no", "0") :
+        out["commands"] = cmds
 
-    def find_flow(self, f) :
-        
-        for flow in self.flows :
-            if f == flow :
-                return flow
-        return None
+    response = jsonify(out)
+    response.status_code = 200
+    return response
 
-    def find_flow_by_prefix(self, prefix) :
 
-        for f in self.flows :
-            if f.prefix == prefix :
-                return f
-            if f.prefix_natted == prefix :
-                return f
-        return None
+def plan_flow(op, flow, prefix) :
 
-    def add_flow(self, flow) :
+    cmds = []
+    success, msg = rib.plan([(op, flow, prefix)], cmds)[0]
+    results = [{ "prefix" : str(prefix), "success" : success,
+                 "message" : msg }]
+    return plan_response(results, cmds)
 
-        log.info("Add Flow: %s" % flow)
 
-        if not flow.validate(self.fps) :
-            log.error("Validation Failed: %s" % flow)
-            return False
-        
-        if (self.find_flow_by_prefix(flow.prefix) or
-            (flow.prefix_natted and 
-             self.find_flow_by_prefix(flow.prefix_natted))) :
-            log.error("Flow for Prefix '%s(%s)' already exists" %
-                         (flow.prefix, flow.prefix_natted))
-            return False
+@app.route("/plan/add/<prefix>/<preflen>/<prefix_natted>/" +
+           "<preflen_natted>/<start>/<chain_string>",
+           methods = ["GET", "POST"])
+def rest_plan_add_flow(prefix, preflen, prefix_natted, preflen_natted,
+                       start, chain_string) :
+    """ exabgp commands that /add would write, without adding the flow """
 
-        ret = flow.encode(self.fps)
-        if not ret :
-            return False
+    try :
+        prefix, prefix_natted = parse_url_prefixes(prefix, preflen,
+                                                   prefix_natted,
+                                                   preflen_natted)
+    except ValueError as e :
+        response = make_response()
+        response.data = str(e)
+        response.status_code = 400
+        return response
 
-        self.flows.append(flow)
+    flow = Flow(start, chain_string.split("_"), prefix, prefix_natted)
+    return plan_flow("add", flow, prefix)
 
-        flow.announce()
 
-        return True
+@app.route("/plan/override/<prefix>/<preflen>/<prefix_natted>/" +
+           "<preflen_natted>/<start>/<chain_string>",
+           methods = ["GET", "POST"])
+def rest_plan_override_flow(prefix, preflen, prefix_natted, preflen_natted,
+                            start, chain_string) :
+    """ exabgp commands that /override would write """
 
+    try :
+        prefix, prefix_natted = parse_url_prefixes(prefix, preflen,
+                                                   prefix_natted,
+                                                   preflen_natted)
+    except ValueError as e :
+        response = make_response()
+        response.data = str(e)
+        response.status_code = 400
+        return response
 
-    def delete_flow(self, flow) :
+    flow = Flow(start, chain_string.split("_"), prefix, prefix_natted)
+    return plan_flow("override", flow, prefix)
 
-        log.info("Delete Flow : %s" % flow)
 
-        flow.withdraw()
-        self.flows.remove(flow)
-        return
-        
-    def destroy_all_flows(self) :
+@app.route("/plan/delete/<prefix>/<preflen>", methods = ["GET", "POST"])
+def rest_plan_delete_flow(prefix, preflen) :
+    """ exabgp commands that /delete would write """
 
-        log.info("Destroy All Flows")
+    try :
+        prefix = Prefix.parse(prefix + "/" + preflen)
+    except ValueError as e :
+        response = make_response()
+        response.data = str(e)
+        response.status_code = 400
+        return response
 
-        while self.flows :
-            flow = self.flows.pop()
-            flow.withdraw()
+    return plan_flow("delete", None, prefix)
 
 
-def load_config(configjson) :
+@app.route("/plan/bulk", methods = ["POST"])
+def rest_plan_bulk() :
+    """ exabgp commands that /bulk with the same body would write """
 
-    log.info("Start to load config file %s" % configjson)
+    try :
+        entries = parse_bulk_body(request.get_data(as_text = True))
+    except ValueError as e :
+        response = make_response()
+        response.data = "Invalid bulk request: %s" % e
+        response.status_code = 400
+        return response
 
-    fps = []
+    cmds = []
+    results = bulk_results(entries, lambda ops : rib.plan(ops, cmds))
+    return plan_response(results, cmds)
 
-    with open(configjson, 'r') as f :
-        cfg = json.load(f)
 
-    for fpname, v in cfg.items() :
-        log.info("Load Function Pool %s" % fpname)
+@app.route("/plan/reload", methods = ["GET", "POST"])
+def rest_plan_reload() :
+    """ exabgp commands that /reload would write with the config file
+    now, and the summary of the changes.
+    """
 
-        fp = FunctionPool(fpname,
-                          cfg[fpname]["community"], cfg[fpname]["neighbor"])
+    cmds = []
+    try :
+        fps = FunctionPools(load_config(config_path))
+        summary = rib.plan_reload(fps, cmds)
+    except (OSError, ValueError, KeyError, TypeError, RuntimeError) as e :
+        log.error("Failed to load config file %s: %s" % (config_path, e))
+        summary = None
+
+    if not summary :
+        response = make_response()
+        response.data = log.errmsg
+        response.status_code = 400
+        return response
 
-        for f in v["function"] :
-            log.info("Add Function %s to %s" % (f["name"], fpname))
+    return plan_response(None, cmds, summary)
 
-            fn = Function(f["name"], f["rd-top"], f["rd-bot"],
-                          f["mark-top"], f["mark-bottom"],
-                          f["cgn"])
-            fp.add_function(fn)
 
-        for fpname, rd in v["inter-fp-rd"]["global"].items() :
-            fp.add_inter_fp_rd("global", fpname, rd)
+OPERATION_WAIT_LIMIT = 60 # max seconds to wait for an operation
+OPERATION_RESPONSE_TIMEOUT = 600 # max seconds a request waits before 202
 
-        for fpname, rd in v["inter-fp-rd"]["private"].items() :
-            fp.add_inter_fp_rd("private", fpname, rd)
 
-            
-        for vrfname, rd in v["user-vrf-rd"].items() :
-            fp.add_user_vrf_rd(vrfname, rd)
-        
-        fps.append(fp)
+def operation_response(op) :
+    """ response of an operation submitted by a REST handler. the
+    handler waits for the operation, or returns 202 and the operation in
+    JSON immediately if async=true or if the operation is not done in
+    OPERATION_RESPONSE_TIMEOUT seconds. the operation is polled or
+    awaited at /operation/<id>.
+    """
 
-    return fps
+    if (request.args.get("async", "").lower() in ("true", "yes", "1") or
+        not op.wait(OPERATION_RESPONSE_TIMEOUT)) :
+        response = jsonify(op.json())
+        response.status_code = 202
+        response.headers["Location"] = "/operation/%d" % op.id
+        return response
 
+    if op.result is None or isinstance(op.result, str) :
+        response = make_response()
+        response.data = op.result
+    else :
+        response = jsonify(op.result)
+    response.status_code = 200 if op.success else 400
 
+    response.headers["X-Operation-Id"] = str(op.id)
+    return response
 
-""" REST API """
 
-@app.route("/add/<prefix>/<preflen>/<prefix_natted>/<preflen_natted>/" +
-           "<start>/<chain_string>",
-           methods = ["GET", "POST"])
-def rest_add_flow(prefix, preflen, prefix_natted, preflen_natted,
-                  start, chain_string) :
-    """
-    @start : user vrf name
-    @prefix: user prefix
-    @prefix_natted: user prefix after NAT. if not, use 'none'.
-    @chain : <fpname>_<fpname>_<fpname>...
+@app.route("/operation/<int:id>", methods = ["GET"])
+def rest_operation(id) :
+    """ state of an operation. wait=SECONDS waits for the operation to
+    be done, up to OPERATION_WAIT_LIMIT seconds.
     """
-    
-    chain = chain_string.split("_")
-    prefix += "/" + preflen
-    if prefix_natted == "none" :
-        prefix_natted = None
-    else :
-        prefix_natted += "/" + preflen_natted
-
-    response = make_response()
 
-    flow = Flow(start, chain, prefix, prefix_natted)
-    if not flow.validate(rib.fps) :
-        response.data = log.errmsg
-        response.status_code = 400
+    op = control.find(id)
+    if not op :
+        response = make_response()
+        response.data = "No operation %d" % id
+        response.status_code = 404
         return response
 
-    if not rib.add_flow(flow) :
-        response.data = log.errmsg
+    try :
+        wait = float(request.args.get("wait", 0))
+    except ValueError :
+        response = make_response()
+        response.data = "Invalid wait '%s'" % request.args.get("wait")
         response.status_code = 400
         return response
 
-    response.data = "Flow : %s is added" % flow
+    if wait > 0 :
+        op.wait(min(wait, OPERATION_WAIT_LIMIT))
+
+    response = jsonify(op.json())
     response.status_code = 200
 
     return response
 
 
-@app.route("/override/<prefix>/<preflen>/<prefix_natted>/<preflen_natted>/" +
-           "<start>/<chain_string>",
-           methods = ["GET", "POST"])
-def rest_override_flow(prefix, preflen, prefix_natted, preflen_natted,
-                       start, chain_string) :
-    """
-    @start : user vrf name
-    @prefix: user prefix
-    @prefix_natted: user prefix after NAT. if not, use 'none'.
-    @chain : <fpname>_<fpname>_<fpname>...
-    """
-    
-    chain = chain_string.split("_")
-    prefix += "/" + preflen
-    if prefix_natted == "none" :
-        prefix_natted = None
-    else :
-        prefix_natted += "/" + preflen_natted
+@app.route("/show/operation", methods = ["GET"])
+def rest_show_operation() :
 
+    response = jsonify(control.stats())
+    response.status_code = 200
 
-    response = make_response()
+    return response
 
-    flow = Flow(start, chain, prefix, prefix_natted)
 
+QUERY_LIMIT = 1000 # default and maximum number of flows in a page
 
-    if not flow.validate(rib.fps) :
-        response.data = log.errmsg
-        response.status_code = 400
-        return response
 
-    if (rib.find_flow_by_prefix(flow.prefix) or
-        (flow.prefix_natted and 
-         rib.find_flow_by_prefix(flow.prefix_natted))) :
-        remove_flow = rib.find_flow_by_prefix(prefix)
-        if not remove_flow :
-            remove_flow = rib.find_flow_by_prefix(flow.prefix_natted)
+def parse_query(args) :
+    """ keyword arguments for RoutingInformationBase.query() from the
+    query string of /show/flow. raises ValueError for invalid values.
+    """
 
-        rib.delete_flow(remove_flow)
+    kwargs = {
+        "cursor" : 0,
+        "limit" : QUERY_LIMIT,
+    }
+
+    for name in ("cursor", "limit") :
+        if name in args :
+            try :
+                kwargs[name] = int(args[name])
+            except ValueError :
+                raise ValueError("Invalid %s '%s'" % (name, args[name]))
+            if kwargs[name] < (1 if name == "limit" else 0) :
+                raise ValueError("Invalid %s '%s'" % (name, args[name]))
+    kwargs["limit"] = min(kwargs["limit"], QUERY_LIMIT)
+
+    for name in ("prefix", "covering") :
+        if name in args :
+            kwargs[name] = Prefix.parse(args[name])
+
+    for name in ("vrf", "function", "fp", "neighbor") :
+        if name in args :
+            kwargs[name] = args[name]
+
+    if "cgn" in args :
+        cgn = args["cgn"].lower()
+        if cgn in ("true", "yes", "1") :
+            kwargs["cgn"] = True
+        elif cgn in ("false", "no", "0") :
+            kwargs["cgn"] = False
+        else :
+            raise ValueError("Invalid cgn '%s'" % args["cgn"])
 
-    if not rib.add_flow(flow) :
-        response.data = log.errmsg
-        response.status_code = 400
-        return response
+    return kwargs
 
-    response.data = "Flow : %s is overridden" % flow
-    response.status_code = 200
 
-    return response
+def stream_flow_view(view, flows) :
+    """ generate the body of a view of /show/flow for flows """
 
+    if view == "html" :
+        yield "<html>\n"
+        for flow in flows :
+            yield "<pre>%s</pre>\n" % flow.render("extensive")
+        yield "</html>"
 
+    elif view == "json" :
+        yield "["
+        for x, flow in enumerate(flows) :
+            yield "%s%s" % ("," if x else "", flow.render(view))
+        yield "]\n"
 
-@app.route("/delete/<prefix>/<preflen>", methods = ["GET", "POST"])
-def rest_delete_flow(prefix, preflen) :
-    """
-    @prefix: user prefix for deleting flow
-    """
+    else :
+        for x, flow in enumerate(flows) :
+            yield "%s%s" % ("\n" if x else "", flow.render(view))
 
-    prefix += "/" + preflen
-    response = make_response()
 
-    flow = rib.find_flow_by_prefix(prefix)
-    if not flow :
-        response.data = "No matched flor for %s" % prefix
+def show_flow_page(view, mimetype) :
+    """ response for a page of flows matching the query string.
+    X-Next-Cursor header is the cursor for the next page.
+    """
+
+    try :
+        kwargs = parse_query(request.args)
+        with rib.lock.read() :
+            flows, cursor = rib.query(**kwargs)
+    except ValueError as e :
+        response = make_response()
+        response.data = str(e)
         response.status_code = 400
         return response
 
-    rib.delete_flow(flow)
-    response.data = "Flow: %s is deleted" % flow
-    response.status_code = 200
+    # flows are not modified after insertion into the RIB, so they
+    # are rendered without the lock.
+    response = Response(stream_flow_view(view, flows), mimetype = mimetype)
+    if cursor is not None :
+        response.headers["X-Next-Cursor"] = str(cursor)
 
     return response
-    
 
-@app.route("/destroy", methods = ["GET", "POST"])
-def rest_destroy() :
 
-    rib.destroy_all_flows()
+def show_flow_view(view, mimetype = "text/html") :
+    """ response for a view of /show/flow with ETag. if the RIB has not
+    changed since the ETag in If-None-Match, 304 is returned.
+    with query string (see parse_query), a page of flows is returned.
+    """
+
+    for name in request.args :
+        if name in ("cursor", "limit", "prefix", "covering", "vrf",
+                    "function", "fp", "cgn", "neighbor") :
+            return show_flow_page(view, mimetype)
+
     response = make_response()
 
-    response.data = "Destroyed all flows"
-    response.status_code = 200
+    with rib.lock.read() :
+        etag = rib.etag(view)
+        if request.if_none_match.contains(etag) :
+            response.status_code = 304
+        else :
+            response.data = rib.render(view)
+            response.status_code = 200
+
+    response.set_etag(etag)
+    response.mimetype = mimetype
 
     return response
 
 
 @app.route("/show/flow", methods = ["GET"])
 def rest_show_flow() :
+    return show_flow_view("show")
 
-    outputs = []
 
-    for flow in rib :
-        outputs.append(flow.show())
+@app.route("/show/flow/extensive", methods = ["GET"])
+def rest_show_flow_extensive() :
+    return show_flow_view("extensive")
+
 
-    response = make_response()
-    response.data = "\n".join(outputs)
+@app.route("/show/flow/html", methods = ["GET"])
+def rest_show_flow_html() :
+    return show_flow_view("html")
+
+
+@app.route("/show/flow/url", methods = ["GET"])
+def rest_show_flow_url() :
+    return show_flow_view("url")
+
+
+@app.route("/show/flow/json", methods = ["GET"])
+def rest_show_flow_json() :
+    return show_flow_view("json", mimetype = "application/json")
+
+
+def stream_export_flows() :
+    """ generate one line of JSON for each flow """
+
+    for flow in rib.export() :
+        yield flow.render("json") + "\n"
+
+
+def stream_export_routes() :
+    """ generate announce commands of TOS flows and all flows """
+
+    with rib.lock.read() :
+        eroutes, iroutes = rib.fps.announced_tos_flow_routes()
+    for route in eroutes + iroutes :
+        yield route + "\n"
+
+    for flow in rib.export() :
+        yield "".join([r + "\n" for r in flow.commands("announce")])
+
+
+@app.route("/export/flow", methods = ["GET"])
+def rest_export_flow() :
+    return Response(stream_export_flows(), mimetype = "application/x-ndjson")
+
+
+@app.route("/export/routes", methods = ["GET"])
+def rest_export_routes() :
+    return Response(stream_export_routes(), mimetype = "text/plain")
+
+
+@app.route("/show/writer", methods = ["GET"])
+def rest_show_writer() :
+
+    response = jsonify(writer.stats())
     response.status_code = 200
 
     return response
 
 
-@app.route("/show/flow/extensive", methods = ["GET"])
-def rest_show_flow_extensive() :
+def neighbor_stats(address) :
+    """ session state, emission queue and the number of flows of a
+    neighbor
+    """
+
+    stats = reader.neighbor_state(address)
+    stats["queue"] = writer.neighbor_stats(address)
+    with rib.lock.read() :
+        stats["flows"] = len(rib.indexes["neighbor"].get(address, ()))
+    return stats
 
-    outputs = []
 
-    for flow in rib :
-        outputs.append(flow.show(extensive = True))
+def known_neighbor(address) :
+    """ True if the address is a neighbor of a function pool, or a
+    neighbor that exabgp or the writer knows.
+    """
+
+    return (address in [fp.neighbor for fp in rib.fps.fps] or
+            address in reader.neighbors or address in writer.neighbors)
+
+
+def unknown_neighbor(address) :
 
     response = make_response()
-    response.data = "\n".join(outputs)
+    response.data = "Unknown neighbor '%s'" % address
+    response.status_code = 404
+    return response
+
+
+@app.route("/show/neighbor", methods = ["GET"])
+def rest_show_neighbor() :
+
+    stats = reader.stats([fp.neighbor for fp in rib.fps.fps] +
+                         list(writer.neighbors))
+    for address in stats["neighbors"] :
+        stats["neighbors"][address] = neighbor_stats(address)
+
+    response = jsonify(stats)
     response.status_code = 200
 
     return response
 
-@app.route("/show/flow/html", methods = ["GET"])
-def rest_show_flow_html() :
-
-    outputs = ["<html>"]
 
-    if not rib.len() :
-        outputs.append("no flow installed.")
-    else :
-        for flow in rib :
-            outputs.append(flow.show(extensive = True, html = True))
+@app.route("/show/neighbor/<address>", methods = ["GET"])
+def rest_show_neighbor_address(address) :
 
-    outputs.append("</html>")
+    if not known_neighbor(address) :
+        return unknown_neighbor(address)
 
-    response = make_response()
-    response.data = "\n".join(outputs)
+    response = jsonify(neighbor_stats(address))
     response.status_code = 200
 
     return response
 
 
-@app.route("/show/flow/url", methods = ["GET"])
-def rest_show_flow_url() :
+def stream_neighbor_routes(address) :
+    """ generate announce commands of TOS flows and flows to a neighbor
+    """
 
-    outputs = []
-    
-    for flow in rib :
-        outputs.append(flow.url())
+    with rib.lock.read() :
+        cmds = rib.neighbor_tos_commands(address)
+    for cmd in cmds :
+        yield cmd + "\n"
 
-    response = make_response()
-    response.data = "\n".join(outputs)
+    for flow in rib.export(neighbor = address) :
+        yield "".join([r + "\n" for r in
+                       flow.commands("announce", neighbor = address)])
+
+
+@app.route("/show/neighbor/<address>/routes", methods = ["GET"])
+def rest_show_neighbor_routes(address) :
+
+    if not known_neighbor(address) :
+        return unknown_neighbor(address)
+
+    return Response(stream_neighbor_routes(address), mimetype = "text/plain")
+
+
+@app.route("/neighbor/<address>/<op>", methods = ["GET", "POST"])
+def rest_neighbor(address, op) :
+    """ resync, pause, resume or drain the routes to a neighbor """
+
+    if not known_neighbor(address) :
+        return unknown_neighbor(address)
+
+    if op == "resync" :
+        routes = replay_neighbor(address)
+        log.info("Resynced %d routes to neighbor %s" % (routes, address))
+    elif op == "pause" :
+        writer.pause(address)
+    elif op == "resume" :
+        writer.pause(address, paused = False)
+    elif op == "drain" :
+        routes = writer.drain(address)
+        reader.drained(address)
+        log.info("Drained %d routes queued to neighbor %s" %
+                 (routes, address))
+    else :
+        response = make_response()
+        response.data = "Invalid operation '%s'" % op
+        response.status_code = 400
+        return response
+
+    response = jsonify(neighbor_stats(address))
     response.status_code = 200
 
     return response
 
-@app.route("/show/flow/json", methods = ["GET"])
-def rest_show_flow_json() :
 
-    flows = []
+@app.route("/neighbor/<address>/rate/<int:rate>", methods = ["GET", "POST"])
+def rest_neighbor_rate(address, rate) :
+    """ limit routes per second to a neighbor, 0 means no limit """
 
-    for flow in rib :
-        flows.append(flow.json())
+    if not known_neighbor(address) :
+        return unknown_neighbor(address)
 
-    response = jsonify(flows)
+    writer.set_rate(address, rate)
+    log.info("Limit routes to neighbor %s to %d per second" %
+             (address, rate))
+
+    response = jsonify(neighbor_stats(address))
     response.status_code = 200
 
     return response
 
 
-""" Misc """
+@app.route("/show/cache", methods = ["GET"])
+def rest_show_cache() :
 
-def whichipversion(addr) :
+    response = jsonify(rib.fps.chain_cache_stats())
+    response.status_code = 200
 
-    if re.match(r'^(\d{1,3}\.){3,3}\d{1,3}$', addr)  :
-        return 4
+    return response
 
-    if re.match(r'((([0-9a-f]{1,4}:){7}([0-9a-f]{1,4}|:))|(([0-9a-f]{1,4}:){6}(:[0-9a-f]{1,4}|((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){5}(((:[0-9a-f]{1,4}){1,2})|:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9a-f]{1,4}:){4}(((:[0-9a-f]{1,4}){1,3})|((:[0-9a-f]{1,4})?:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){3}(((:[0-9a-f]{1,4}){1,4})|((:[0-9a-f]{1,4}){0,2}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){2}(((:[0-9a-f]{1,4}){1,5})|((:[0-9a-f]{1,4}){0,3}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9a-f]{1,4}:){1}(((:[0-9a-f]{1,4}){1,6})|((:[0-9a-f]{1,4}){0,4}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(:(((:[0-9a-f]{1,4}){1,7})|((:[0-9a-f]{1,4}){0,5}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:)))(%.+)?\s*$', addr) :
-        return 6
 
-    return -1
+def collect_metrics() :
+    """ families of metrics collected at the time of /metrics, see
+    Metrics.render
+    """
 
+    families = []
+
+    def family(name, mtype, help, values) :
+        families.append((name, mtype, help, values))
+
+    with rib.lock.read() :
+        family("flowchain_flows", "gauge", "flows in the RIB",
+               [((), rib.len())])
+        for name, label, help in (("vrf", "vrf", "user VRF"),
+                                  ("fp", "pool", "function pool"),
+                                  ("neighbor", "neighbor", "neighbor")) :
+            family("flowchain_flows_by_%s" % label, "gauge",
+                   "flows in the RIB per %s" % help,
+                   [(((label, key),), len(index)) for key, index in
+                    sorted(rib.indexes[name].items())])
+        family("flowchain_flows_by_chain", "gauge",
+               "flows in the RIB per chain",
+               [((("chain", chain),), count) for chain, count in
+                sorted(rib.chains.items())])
+        tos = sum([len(e) + len(i)
+                   for e, i in rib.fps.tos_announced.values()])
+        family("flowchain_tos_flow_routes", "gauge",
+               "routes of TOS flows announced", [((), tos)])
+        table = route_table.stats()
+        cache = rib.fps.chain_cache_stats()
+
+    family("flowchain_route_table_routes", "gauge",
+           "distinct routes referenced in the route table",
+           [((), table["routes"])])
+    family("flowchain_route_table_suppressed_total", "counter",
+           "commands not written as the routes are shared",
+           [((), table["suppressed"])])
+
+    family("flowchain_chain_cache_hits_total", "counter",
+           "compiled chain templates found in the cache",
+           [((), cache["hits"])])
+    family("flowchain_chain_cache_misses_total", "counter",
+           "chain templates compiled", [((), cache["misses"])])
+
+    stats = writer.stats()
+    family("flowchain_writer_queue_depth", "gauge",
+           "commands queued to exabgp per neighbor",
+           [((("neighbor", address),), q["queue_depth"])
+            for address, q in sorted(stats["neighbors"].items())])
+    family("flowchain_writer_routes_written_total", "counter",
+           "commands written to exabgp", [((), stats["routes_written"])])
+    family("flowchain_writer_writes_total", "counter",
+           "writes to the pipe to exabgp", [((), stats["writes"])])
+    family("flowchain_writer_backpressure_events_total", "counter",
+           "writes blocked by full queues",
+           [((), stats["backpressure_events"])])
+    family("flowchain_writer_backpressure_seconds_total", "counter",
+           "seconds writes blocked by full queues",
+           [((), stats["backpressure_seconds"])])
+    family("flowchain_writer_unacked", "gauge",
+           "commands written and not acknowledged by exabgp",
+           [((), stats["unacked"])])
+
+    stats = control.stats()
+    family("flowchain_operations_pending", "gauge",
+           "operations submitted and not done", [((), stats["pending"])])
+
+    if reader.running :
+        stats = reader.stats()
+        family("flowchain_exabgp_acks_total", "counter",
+               "commands acknowledged by exabgp", [((), stats["acks"])])
+        family("flowchain_exabgp_errors_total", "counter",
+               "commands exabgp failed", [((), stats["errors"])])
+        family("flowchain_neighbor_up", "gauge",
+               "1 if the session to the neighbor is up",
+               [((("neighbor", address),), int(peer["state"] == "up"))
+                for address, peer in sorted(stats["neighbors"].items())])
+
+    return families
+
+
+@app.route("/metrics", methods = ["GET"])
+def rest_metrics() :
 
-def validate_prefix(prefix) :
+    response = make_response()
+    response.data = metrics.render(collect_metrics())
+    response.status_code = 200
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
 
-    p, l = prefix.split("/")
-    v = whichipversion(p)
+    return response
 
-    try :
-        preflen = int(l)
-    except :
-        log.error("Invalid Prefix '%s'" % prefix)
-        return False
 
-    if v == 4 :
-        if preflen < 0 or preflen > 32 :
-            log.error("Invalid IPv4 Prefix '%s'" % prefix)
+""" Misc """
 
-            return False
-    elif v == 6 :
-        if preflen < 0 or preflen > 128 :
-            log.error("Invalid IPv6 Prefix '%s'" % prefix)
+class QuietRequestHandler(WSGIRequestHandler) :
+    """ do not write an access log line to stderr for each request """
 
-            return False
-    else :
-        log.error("Invalid Prefix '%s'" % prefix)
-        return False
+    protocol_version = "HTTP/1.1" # keep-alive
 
-    return True
+    def log_request(self, *args, **kwargs) :
+        return
 
 
+def serve(server, host, port, threads) :
+    """ run the REST API server in this process, so that only the
+    writer thread of this process writes to the exabgp pipe.
+    """
 
-def main() :
+    log.info("Start %s REST API server on %s:%d" % (server, host, port))
+
+    if server == "debug" :
+        # the reloader runs main() again in a child process, which
+        # would announce the routes twice. so, never use it.
+        app.run(host = host, port = port, debug = True,
+                use_reloader = False)
+
+    elif server == "waitress" :
+        try :
+            import waitress
+        except ImportError :
+            log.error("waitress is not installed")
+            sys.exit(1)
+        waitress.serve(app, host = host, port = port, threads = threads)
+
+    else :
+        srv = make_server(host, port, app, threaded = True,
+                          request_handler = QuietRequestHandler)
+        srv.serve_forever()
 
-    global rib
+    return
 
-    fps = FunctionPools(load_config(CONFIG_JSON))
+
+def main() :
+
+    global rib, config_path
+
+    desc = "flowchain: chaining functions using flowspec via exabgp"
+    parser = argparse.ArgumentParser(description = desc)
+    parser.add_argument("--config", default = CONFIG_JSON,
+                        help = "config file (default %s)" % CONFIG_JSON)
+    parser.add_argument("--bind", default = "0.0.0.0",
+                        help = "address of REST API (default 0.0.0.0)")
+    parser.add_argument("--port", type = int, default = 5000,
+                        help = "port of REST API (default 5000)")
+    parser.add_argument("--server", default = "threaded",
+                        choices = ["threaded", "waitress", "debug"],
+                        help = "REST API server. threaded: multi-threaded " +
+                        "server, waitress: waitress if installed, " +
+                        "debug: flask debug server (default threaded)")
+    parser.add_argument("--threads", type = int, default = 8,
+                        help = "number of threads for waitress (default 8)")
+    parser.add_argument("--routes-per-second", type = int, default = 0,
+                        help = "max routes written to exabgp per second, " +
+                        "0 means no limit (default 0)")
+    parser.add_argument("--neighbor-routes-per-second", type = int,
+                        default = 0,
+                        help = "max routes written to each neighbor per " +
+                        "second, 0 means no limit (default 0)")
+    parser.add_argument("--max-queue", type = int, default = 100000,
+                        help = "number of queued routes to a neighbor " +
+                        "that blocks API requests (default 100000)")
+    parser.add_argument("--journal", default = JOURNAL,
+                        help = "journal file to persist flows, " +
+                        "empty string disables it (default %s)" % JOURNAL)
+    parser.add_argument("--compact-every", type = int, default = 10000,
+                        help = "number of journal records to write " +
+                        "a new snapshot (default 10000)")
+    parser.add_argument("--encode-workers", type = int, default = 1,
+                        help = "processes to compile chains of bulk, " +
+                        "journal replay and reload, 0 means the number " +
+                        "of CPUs (default 1)")
+    parser.add_argument("--feedback", action = "store_true",
+                        help = "read neighbor states and acknowledgements " +
+                        "of commands from exabgp (stdin)")
+    args = parser.parse_args()
+
+    writer.routes_per_second = args.routes_per_second
+    writer.neighbor_routes_per_second = args.neighbor_routes_per_second
+    writer.max_queue = args.max_queue
+    writer.track_acks = args.feedback
+    writer.start()
+    atexit.register(writer.flush, 5)
+
+    config_path = args.config
+    fps = FunctionPools(load_config(config_path))
     rib = RoutingInformationBase(fps)
+    rib.encode_workers = args.encode_workers or os.cpu_count()
+    control.start()
+
+    if args.feedback :
+        reader.on_established = replay_neighbor
+        reader.start(control)
+
+    # restore the RIB from the journal first, and then the TOS flows
+    if args.journal :
+        journal = Journal(args.journal, compact_every = args.compact_every)
+        journal.replay(rib)
+        with rib.lock.write() :
+            journal.compact(rib)
+            rib.journal = journal
 
     fps.generate_tos_flows()
-    
-    app.run(host = "0.0.0.0", debug = True)
+
+    signal.signal(signal.SIGHUP, reload_on_sighup)
+
+    serve(args.server, args.bind, args.port, args.threads)
 
 
 if __name__ == '__main__' :